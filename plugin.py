@@ -5,6 +5,17 @@
 """
 <plugin key="Onkyo" name="Onkyo AV Receiver" author="jorgh" version="0.2.1" wikilink="https://github.com/jorgh6/domoticz-onkyo-plugin/wiki" externallink="https://github.com/jorgh6/domoticz-onkyo-plugin">
   <params>
+    <param field="Mode1" label="Command interval (ms)" width="75px" required="false" default="150"/>
+    <param field="Mode2" label="Macros" width="300px" required="false" default=""/>
+    <param field="Mode3" label="State feed port" width="75px" required="false" default=""/>
+    <param field="Mode4" label="Metrics" width="75px">
+      <options>
+        <option label="Off" value="Off" default="true" />
+        <option label="Log" value="Log"/>
+        <option label="Devices" value="Devices"/>
+      </options>
+    </param>
+    <param field="Mode5" label="Debug subsystems" width="300px" required="false" default=""/>
     <param field="Mode6" label="Debug" width="75px">
       <options>
         <option label="True" value="Debug"/>
@@ -15,26 +26,30 @@
 </plugin>
 """
 import Domoticz
-import socket
+import bisect
+import hashlib
+import heapq
+import json
+import math
+import os
+import pickle
+import queue
+import random
+import re
+import struct
+import threading
+import time
 import xml.etree.ElementTree as XMLTree
+from enum import IntEnum
 
 #DEFINES -- Sort of ;-)
-MESSAGE_HEADER_1 = 'ISCP\x00\x00\x00\x10\x00\x00\x00'
-MESSAGE_HEADER_2 = '\x01\x00\x00\x00'
-MESSAGE_TRAILER = '\x0D\x0A'
-MESSAGE_POWER = '!1PWR'
-MESSAGE_MUTE = '!1AMT'
-MESSAGE_MUTE2 = '!1ZMT'
-MESSAGE_POWER2 = '!1ZPW'
-MESSAGE_VOLUME = '!1MVL'
-MESSAGE_VOLUME2 = '!1ZVL'
-MESSAGE_SOURCE = '!1SLI'
-MESSAGE_SOURCE2 = '!1SLZ'
+CACHE_VERSION = 2                            # Version of the cached receiver model format
+MESSAGE_TRAILER = b'\x0D\x0A'
+MESSAGE_KEEPALIVE = '!1PWRQSTN'
 MESSAGE_LISTENINGMODE = '!1LMD' 
 MESSAGE_TUNERPRESET = '!1PRS'
 MESSAGE_DISCOVER = '!xECNQSTN'
 MESSAGE_RECEIVER_INFORMATION = '!1NRIQSTN'
-BUFFER_SIZE = 4096
 MAINPOWER = 1
 MAINSOURCE = 2
 MAINVOLUME = 3
@@ -43,588 +58,2101 @@ TUNERPRESETS = 5
 ZONE2POWER = 6
 ZONE2SOURCE = 7
 ZONE2VOLUME = 8
+MACROS = 9
+METADATA_TITLE = 24                          # Now playing text devices of the network and USB sources
+METADATA_ARTIST = 25
+METADATA_ALBUM = 26
+METADATA_TIME = 27
+UNITS_PER_RECEIVER = 40                      # Number of units reserved for the devices of each receiver
+MAX_RECEIVERS = 6
 UDP_PORT = 60128
-EOF = 23
-NA = -1
+ISCP_HEADER = struct.Struct('>4sII')         # 'ISCP', header size, data size (big-endian)
+ISCP_FRAME_HEADER = struct.Struct('>4sIIB3x')   # The complete header of an outgoing frame, with version and reserved bytes
+ISCP_VERSION = 1
+ISCP_MIN_HEADER_SIZE = 16
+ISCP_MAX_FRAME_SIZE = 1048576                # Larger header or data sizes come from a corrupted header
+ISCP_COMPACT_SIZE = 65536                    # Compact the parser buffer once this much has been consumed
+ISCP_STREAMED = (b'NRI',)                    # Commands of which the payload is passed on while it arrives
+ISCP_TRAILER_SIZE = 3                        # EOF, CR and LF at the end of a frame
+COMMAND_INTERVAL = 150                       # Default minimum time in milliseconds between two frames send to the receiver
+COMMAND_COALESCE = ('MVL', 'ZVL', 'PRS', 'SLI', 'SLZ')   # Only the latest queued value of these commands is send
+COMMAND_ACK_TIMEOUT = 3.0                    # Seconds for the receiver to report the state a command set, before it is send again
+COMMAND_RETRIES = 2                          # Times a command is send again before it is reported as failed
+COMMAND_VALUE = re.compile(r'^[0-9A-Fa-f]{2}$')   # Parameters the receiver reports back as they were send
+MACRO_ACK_COMMANDS = ('PWR', 'ZPW', 'SLI', 'SLZ')   # The rest of a macro waits until the receiver reports these
+MACRO_ACK_TIMEOUT = 5.0                      # Seconds to wait for such a report before the macro goes on anyway
+MACRO_STEP = re.compile(r'^(?:(?P<delay>\d+)MS|(?P<message>[A-Z][A-Z0-9]{2}[A-Z0-9\-\+]+))$')
+DISCOVERY_INTERVAL = 2                       # Seconds before the first discovery broadcast is repeated
+DISCOVERY_MAX_INTERVAL = 60                  # The interval doubles after every broadcast, up to this value
+RECONNECT_DELAY = 1.0                        # Seconds before the second reconnect attempt, the first one is immediate
+RECONNECT_MAX_DELAY = 30.0                   # The delay doubles after every failed attempt, up to this value
+RECONNECT_ATTEMPTS = 5                       # Failed reconnects before we look for the receiver with discovery again
+STATE_QUERY_TIMEOUT = 2.0                    # Seconds to wait for the answers to the state queries before asking again
+STATE_QUERY_RETRIES = 3                      # Number of times unanswered state queries are repeated
+DEVICE_COALESCE_TIME = 1.0                   # Minimum time in seconds between two updates of the same device
+XML_RETRY_INTERVAL = 10.0                    # Seconds to wait for the receiver information before asking again
+KEEPALIVE_INTERVAL = 60.0                    # Poll an idle receiver this often, the connection is dead after two silent intervals
+STATE_VERIFY_INTERVAL = 600.0                # Query the state of all zones again this often, in case we missed an update
+HEARTBEAT_MAX = 30                           # Longest heartbeat Domoticz accepts
+METADATA = (('NTI', 'title', METADATA_TITLE, 'Title'), ('NAT', 'artist', METADATA_ARTIST, 'Artist'), \
+            ('NAL', 'album', METADATA_ALBUM, 'Album'))   # Command, state feed key, unit offset, device name
+METADATA_TIME_INTERVAL = 15.0                # The play time (NTM) comes every second, its device is updated this often
+ART_TYPES = {'0': '.bmp', '1': '.jpg'}       # Cover art image types of NJA and the extension of their file
+ART_MAX_SIZE = 1048576                       # Larger cover art is dropped
+FEED_NAME = 'Onkyo Feed'                     # Name of the listening connection of the state feed
+FEED_LOCAL_ADDRESSES = ('127.0.0.1', '::1', '::ffff:127.0.0.1', 'localhost')   # Only local clients may subscribe
+FEED_MAX_LINE = 4096                         # Longer subscription requests are refused
+LOG_DEBUG = 10                               # Log levels
+LOG_INFO = 20
+LOG_ERROR = 40
+LOG_SUBSYSTEMS = ('plugin', 'discovery', 'connection', 'framing', 'dispatch', 'devices', 'commands')
+LOG_REPEAT_WINDOW = 60                       # Identical consecutive messages are summarized for this many seconds
+METRICS_INTERVAL = 300                       # Seconds between two metrics summaries
+METRICS_BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)   # Histogram bucket bounds in ms
+METRICS_FRAMES = 251                         # Units of the optional metrics devices, above the units of the receivers
+METRICS_DISPATCH = 252
+METRICS_ROUNDTRIP = 253
+METRICS_SUMMARY = 254
 
-class Onkyo:
-  enabled = False
-  objConnection = None
+class ControlCommands:
+  # A tone or level control of a zone, as it appears in the controllist of the receiver. It is set
+  # with strCommand and a signed hexadecimal value ('-A' .. '00' .. '+A'), after strPrefix when the
+  # command carries several controls ('TFRB+2T-1' has both bass and treble).
+  __slots__ = ('strControl', 'strCommand', 'strPrefix', 'strKey', 'intUnit')
+
+  def __init__(self, strControl, strCommand, strPrefix, strKey, intUnit):
+    self.strControl = strControl             # Id of the control in the controllist
+    self.strCommand = strCommand
+    self.strPrefix = strPrefix
+    self.strKey = strKey                     # Key of the control in the state feed
+    self.intUnit = intUnit                   # Unit offset of its selector device
+
+class ZoneCommands:
+  # The eISCP commands and the unit offsets of the devices of one zone. The devices, outgoing
+  # frames, status handlers and state queries of every zone the receiver reports in its zonelist
+  # are generated from its row in ZONES, a new zone only needs a new row.
+  __slots__ = ('intId', 'strName', 'strPower', 'strMute', 'strVolume', 'strSource', \
+               'intPowerUnit', 'intSourceUnit', 'intVolumeUnit', 'listControls')
+
+  def __init__(self, intId, strName, strPower, strMute, strVolume, strSource, intPowerUnit, intSourceUnit, intVolumeUnit, listControls):
+    self.intId = intId                       # Zone id in the zonelist, 1 is the main zone
+    self.strName = strName                   # Name of the zone in the state feed
+    self.strPower = strPower
+    self.strMute = strMute
+    self.strVolume = strVolume
+    self.strSource = strSource
+    self.intPowerUnit = intPowerUnit
+    self.intSourceUnit = intSourceUnit
+    self.intVolumeUnit = intVolumeUnit       # Volume device, its On/Off is the mute
+    self.listControls = listControls         # ControlCommands of the zone, used if the controllist has them
+
+ZONES = (ZoneCommands(1, 'main', 'PWR', 'AMT', 'MVL', 'SLI', MAINPOWER, MAINSOURCE, MAINVOLUME, \
+                      (ControlCommands('Bass', 'TFR', 'B', 'bass', 16), ControlCommands('Treble', 'TFR', 'T', 'treble', 17), \
+                       ControlCommands('Center Level', 'CTL', '', 'center', 22), ControlCommands('Subwoofer Level', 'SWL', '', 'subwoofer', 23))),
+         ZoneCommands(2, 'zone2', 'ZPW', 'ZMT', 'ZVL', 'SLZ', ZONE2POWER, ZONE2SOURCE, ZONE2VOLUME, \
+                      (ControlCommands('Bass', 'ZTN', 'B', 'bass', 18), ControlCommands('Treble', 'ZTN', 'T', 'treble', 19))),
+         ZoneCommands(3, 'zone3', 'PW3', 'MT3', 'VL3', 'SL3', 10, 11, 12, \
+                      (ControlCommands('Bass', 'TN3', 'B', 'bass', 20), ControlCommands('Treble', 'TN3', 'T', 'treble', 21))),
+         ZoneCommands(4, 'zone4', 'PW4', 'MT4', 'VL4', 'SL4', 13, 14, 15, ()))
+CONTROL_VALUE = re.compile(r'([A-Z]?)([-+][0-9A-F]+|00)')   # The values in a tone or level status, 'B+2T-1' or '-A'
+
+class ReceiverState(IntEnum):
+  LOST = 0                                   # Not found yet, or given up on, discovery has to find it
+  WAITING = 1                                # Waiting before we try to connect again
+  CONNECTING = 2                             # Connection request is in progress
+  LOADING = 3                                # Connected, waiting for the receiver information
+  SYNCING = 4                                # Connected, waiting for the state of the zones
+  READY = 5                                  # Connected and in sync
+
+class ModelState(IntEnum):
+  # Where the receiver information (NRI) is, the model itself may also come from the cache
+  UNKNOWN = 0                                # Not (or no longer) asked for on this connection
+  REQUESTED = 1                              # NRIQSTN is send, waiting for the XML
+  PARSING = 2                                # The XML is received, the worker builds the model
+  VALIDATED = 3                              # objModel matches the XML of the receiver
+
+class TaskScheduler:
+  # Timer wheel driven by onHeartbeat.
+  # Tasks are kept in a heap ordered by due time and identified by a key, scheduling a key again
+  # replaces the earlier task. A heartbeat only touches the tasks that are due and nextDelay()
+  # tells how long the plugin can sleep until the next one.
+
+  def __init__(self):
+    self.listHeap = []                       # [due time, sequence number, key, function] entries
+    self.dictTasks = {}                      # Key -> entry of the scheduled task
+    self.intSequence = 0                     # Keeps the order of tasks that are due at the same time
+
+  def schedule(self, strKey, fltDelay, fnTask):
+    self.cancel(strKey)
+    self.intSequence += 1
+    listEntry = [time.time() + fltDelay, self.intSequence, strKey, fnTask]
+    self.dictTasks[strKey] = listEntry
+    heapq.heappush(self.listHeap, listEntry)
+
+  def cancel(self, strKey):
+    listEntry = self.dictTasks.pop(strKey, None)
+    if (listEntry != None):
+      listEntry[3] = None                    # Dropped from the heap when it comes up
+
+  def scheduled(self, strKey):
+    return strKey in self.dictTasks
+
+  def runDue(self):
+    # Run the tasks that are due. Tasks scheduled while running wait for the next call, so a task
+    # that reschedules itself without delay can not keep us here.
+    fltNow = time.time()
+    intLast = self.intSequence
+    while (len(self.listHeap) > 0) and (self.listHeap[0][0] <= fltNow) and (self.listHeap[0][1] <= intLast):
+      listEntry = heapq.heappop(self.listHeap)
+      if (listEntry[3] == None):
+        continue
+      del self.dictTasks[listEntry[2]]
+      listEntry[3]()
+
+  def nextDelay(self):
+    # Seconds until the next task is due, None when nothing is scheduled
+    while (len(self.listHeap) > 0) and (self.listHeap[0][3] == None):
+      heapq.heappop(self.listHeap)
+    if (len(self.listHeap) == 0):
+      return None
+    return max(self.listHeap[0][0] - time.time(), 0)
+
+class eISCPParser:
+  # Incremental eISCP frame parser.
+  # Received data is appended to a bytearray, complete frames are cut out of it using a read
+  # offset. Every header is decoded exactly once and the remainder of the buffer is not copied
+  # for every frame, the consumed part is only dropped once in a while (or when it is empty).
+  # The payload of ISCP_STREAMED frames is not buffered: it is passed to fnStream(command, chunk,
+  # first, last) as it arrives, and the frame is yielded with an empty payload when it is complete.
+
+  def __init__(self, fnStream=None):
+    self.bBuffer = bytearray()               # Received data that has not been consumed yet
+    self.intReadPos = 0                      # Offset of the first unconsumed byte in bBuffer
+    self.intGarbage = 0                      # Total number of non eISCP bytes that were discarded
+    self.fnStream = fnStream                 # Gets the payload of streamed frames, None to buffer every frame
+    self.strStream = None                    # Command of the streamed frame we are in the middle of
+    self.intStreamLeft = 0                   # Bytes of that frame that have not been received yet
+    self.blStreamFirst = False               # Is the next chunk the first one of the frame
+
+  def feed(self, Data):
+    # Add received data to the buffer and yield every complete frame as a (command, payload) tuple
+    self.bBuffer += Data
+    while True:
+      tupleFrame = self.nextFrame()
+      if (tupleFrame == None):
+        break
+      if (tupleFrame[0] != None):
+        yield tupleFrame
+    self.compact()
+
+  def nextFrame(self):
+    # Returns (command, payload), (None, None) for a frame that does not contain an ISCP message,
+    # or None if there is no complete frame in the buffer.
+    if (self.strStream != None):
+      return self.streamData()
+    bBuffer = self.bBuffer
+    intStart = bBuffer.find(b'ISCP', self.intReadPos)
+    if (intStart == -1):
+      intKeep = max(len(bBuffer) - 3, self.intReadPos)   # 'ISCP' could be split over two chunks
+      self.intGarbage += intKeep - self.intReadPos
+      self.intReadPos = intKeep
+      return None
+    if (intStart > self.intReadPos):
+      self.intGarbage += intStart - self.intReadPos     # Get rid of left overs in front of the frame
+      self.intReadPos = intStart
+    if (len(bBuffer) - intStart < ISCP_MIN_HEADER_SIZE):
+      return None
+    bMagic, intHeaderSize, intDataSize = ISCP_HEADER.unpack_from(bBuffer, intStart)
+    if (intHeaderSize < ISCP_MIN_HEADER_SIZE) or (intHeaderSize + intDataSize > ISCP_MAX_FRAME_SIZE):
+      self.intGarbage += 1                              # Not a real header, resync on the next 'ISCP'
+      self.intReadPos = intStart + 1
+      return (None, None)
+    intDataStart = intStart + intHeaderSize
+    intEnd = intDataStart + intDataSize
+    if (self.fnStream != None) and (intDataSize >= 5) and (bBuffer.startswith(ISCP_STREAMED, intDataStart+2) == True):
+      if (intDataStart + 5 > len(bBuffer)):
+        return None
+      self.strStream = str(bBuffer[intDataStart+2:intDataStart+5], 'ascii')
+      self.intStreamLeft = intDataSize - 5
+      self.blStreamFirst = True
+      self.intReadPos = intDataStart + 5
+      return self.streamData()
+    if (intEnd > len(bBuffer)):
+      return None                                       # We do not have a complete frame yet
+    self.intReadPos = intEnd
+    while (intEnd > intDataStart) and (bBuffer[intEnd-1] in (0x1A, 0x0D, 0x0A)):
+      intEnd -= 1                                       # Strip EOF, CR and LF
+    if (intEnd - intDataStart < 5) or (bBuffer[intDataStart] != 0x21):
+      return (None, None)                               # No '!' + unit type + 3 letter command
+    with memoryview(bBuffer) as viewBuffer:
+      strCommand = str(viewBuffer[intDataStart+2:intDataStart+5], 'ascii', 'ignore')
+      strMessage = str(viewBuffer[intDataStart+5:intEnd], 'utf-8', 'ignore')
+    return (strCommand, strMessage)
+
+  def streamData(self):
+    # Pass what we have of the payload of a streamed frame to fnStream. The last ISCP_TRAILER_SIZE
+    # bytes are held back until the frame is complete, so the trailer can be stripped.
+    bBuffer = self.bBuffer
+    intAvailable = len(bBuffer) - self.intReadPos
+    if (intAvailable >= self.intStreamLeft):
+      intEnd = self.intReadPos + self.intStreamLeft
+      intDataEnd = intEnd
+      while (intDataEnd > self.intReadPos) and (bBuffer[intDataEnd-1] in (0x1A, 0x0D, 0x0A)):
+        intDataEnd -= 1
+      strCommand = self.strStream
+      self.fnStream(strCommand, bytes(bBuffer[self.intReadPos:intDataEnd]), self.blStreamFirst, True)
+      self.intReadPos = intEnd
+      self.strStream = None
+      self.intStreamLeft = 0
+      return (strCommand, '')
+    intCount = min(intAvailable, self.intStreamLeft - ISCP_TRAILER_SIZE)
+    if (intCount > 0):
+      self.fnStream(self.strStream, bytes(bBuffer[self.intReadPos:self.intReadPos+intCount]), self.blStreamFirst, False)
+      self.blStreamFirst = False
+      self.intReadPos += intCount
+      self.intStreamLeft -= intCount
+    return None
+
+  def compact(self):
+    if (self.intReadPos >= len(self.bBuffer)):
+      self.bBuffer.clear()
+      self.intReadPos = 0
+    elif (self.intReadPos >= ISCP_COMPACT_SIZE):
+      del self.bBuffer[:self.intReadPos]
+      self.intReadPos = 0
+
+  def buffered(self):
+    return len(self.bBuffer) - self.intReadPos
+
+class PluginLog:
+  # Leveled logging with per subsystem debug switches.
+  # Messages are formatted with the % operator only when they are actually written, so a debug
+  # call that is switched off costs a function call. A message that is the same as the previous
+  # one is not written again within LOG_REPEAT_WINDOW, the number of repeats is logged instead.
+
+  def __init__(self):
+    self.intLevel = LOG_INFO
+    self.setDebug = set()                    # Subsystems with debug logging switched on
+    self.strLast = None                      # Last message written
+    self.fltLastTime = 0
+    self.intRepeats = 0                      # Times strLast was suppressed since it was written
+
+  def configure(self, blDebug, strSubsystems):
+    if (blDebug == True):
+      self.intLevel = LOG_DEBUG
+    else:
+      self.intLevel = LOG_INFO
+    self.setDebug = set([strSubsystem.strip().lower() for strSubsystem in strSubsystems.split(',') if strSubsystem.strip() != ''])
+    if (len(self.setDebug) == 0):
+      self.setDebug = set(LOG_SUBSYSTEMS)
+
+  def isDebug(self, strSubsystem):
+    return (self.intLevel <= LOG_DEBUG) and (strSubsystem in self.setDebug)
+
+  def debug(self, strSubsystem, strFormat, *args):
+    if (self.intLevel <= LOG_DEBUG) and (strSubsystem in self.setDebug):
+      self.write(Domoticz.Log, '[' + strSubsystem + '] ' + strFormat, args)
+
+  def info(self, strFormat, *args):
+    if (self.intLevel <= LOG_INFO):
+      self.write(Domoticz.Log, strFormat, args)
+
+  def error(self, strFormat, *args):
+    self.write(Domoticz.Error, strFormat, args)
+
+  def write(self, fnWrite, strFormat, args):
+    if (len(args) > 0):
+      strMessage = strFormat % args
+    else:
+      strMessage = strFormat
+    fltNow = time.time()
+    if (strMessage == self.strLast) and (fltNow - self.fltLastTime < LOG_REPEAT_WINDOW):
+      self.intRepeats += 1
+      return
+    self.flush()
+    self.strLast = strMessage
+    self.fltLastTime = fltNow
+    fnWrite(strMessage)
+
+  def flush(self):
+    # Report the repeats of the last message, called before the next message and from onHeartbeat
+    if (self.intRepeats > 0):
+      Domoticz.Log('Last message repeated ' + str(self.intRepeats) + ' times')
+      self.intRepeats = 0
+      self.fltLastTime = time.time()
+
+class LatencyHistogram:
+  # Distribution of durations in milliseconds over the METRICS_BUCKETS buckets
+
+  def __init__(self):
+    self.listCounts = [0] * (len(METRICS_BUCKETS)+1)   # The last bucket counts everything above the highest bound
+    self.intCount = 0
+    self.fltTotal = 0
+    self.fltMax = 0
+
+  def observe(self, fltMs):
+    self.listCounts[bisect.bisect_left(METRICS_BUCKETS, fltMs)] += 1
+    self.intCount += 1
+    self.fltTotal += fltMs
+    if (fltMs > self.fltMax):
+      self.fltMax = fltMs
+
+  def percentile(self, fltFraction):
+    # Upper bound of the bucket that holds the requested percentile, never more than the maximum
+    intTarget = math.ceil(self.intCount * fltFraction)
+    intSeen = 0
+    for intIndex in range(0, len(METRICS_BUCKETS)):
+      intSeen += self.listCounts[intIndex]
+      if (intSeen >= intTarget):
+        return min(METRICS_BUCKETS[intIndex], self.fltMax)
+    return self.fltMax
+
+  def summary(self):
+    if (self.intCount == 0):
+      return '-'
+    return 'p50 %.1f p95 %.1f max %.1f ms (%d)' % (self.percentile(0.5), self.percentile(0.95), self.fltMax, self.intCount)
+
+class Metrics:
+  # Counters and latency histograms of the hot paths, shared by all receivers.
+  # Counters are named 'rx.PWR', 'tx.MVL', 'bytes.garbage' etc. Every METRICS_INTERVAL the plugin logs
+  # a summary and starts a new window. When disabled every method returns right away.
 
   def __init__(self):
-    self.blDiscoverySocketCreated = False    # Has the UDP socket for the Onkyo discovery protocol been created.
-    self.blDiscoveryRequestSend = False      # Has the Discovery Request UDP package been send.
-    self.blDiscoverySucces = False           # Has the Discovery proces succeeded
-    self.blConnectInitiated = False          # Have we initiated the connection request
-    self.blConnected = False                 # Are we connected
-    self.XMLProcessed = False                # Have we processed the XML
-    self.blCheckedDevices = False            # Have the Domoticz devices been checked
-    self.blCheckedStates = False             # Have we fetched the state after startup
-    self.blInitDone = False                  # Has the initialization proces completed
-    self.sockUDP = ''                        # Used for storing the UDP socket
+    self.blEnabled = False
+    self.fltWindowStart = time.time()
+    self.dictCounters = {}                   # Name -> count in the current window
+    self.dictHistograms = {}                 # Name -> LatencyHistogram of the current window
+    self.dictSendTime = {}                   # (connection name, command) -> time the command was send, for the round trip time
+                                             # Commands that are never answered are dropped with the window
+    self.intBuffered = 0                     # Largest number of bytes waiting in a parser buffer
+
+  def count(self, strName, intCount=1):
+    if (self.blEnabled == True):
+      self.dictCounters[strName] = self.dictCounters.get(strName, 0) + intCount
+
+  def observe(self, strName, fltSeconds):
+    if (self.blEnabled == True):
+      objHistogram = self.dictHistograms.get(strName)
+      if (objHistogram == None):
+        objHistogram = self.dictHistograms[strName] = LatencyHistogram()
+      objHistogram.observe(fltSeconds*1000)
+
+  def buffered(self, intBytes):
+    if (self.blEnabled == True) and (intBytes > self.intBuffered):
+      self.intBuffered = intBytes
+
+  def sent(self, strConnection, listMessages):
+    # Frames send to a receiver, the first unanswered one of each command starts a round trip
+    if (self.blEnabled == False):
+      return
+    fltNow = time.perf_counter()
+    for strMessage in listMessages:
+      self.count('tx.' + strMessage[2:5])
+      self.dictSendTime.setdefault((strConnection, strMessage[2:5]), fltNow)
+
+  def received(self, strConnection, strCommand):
+    # A frame from a receiver, the echo or answer of a command we send ends its round trip
+    if (self.blEnabled == False):
+      return
+    self.count('rx.' + strCommand)
+    fltSendTime = self.dictSendTime.pop((strConnection, strCommand), None)
+    if (fltSendTime != None):
+      self.observe('roundtrip', time.perf_counter() - fltSendTime)
+
+  def total(self, strPrefix):
+    return sum([intCount for strName, intCount in self.dictCounters.items() if strName.startswith(strPrefix)])
+
+  def histogram(self, strName):
+    return self.dictHistograms.get(strName, LatencyHistogram())
+
+  def summary(self):
+    fltSeconds = max(time.time() - self.fltWindowStart, 1)
+    intReceived = self.total('rx.')
+    listTop = sorted([(intCount, strName[3:]) for strName, intCount in self.dictCounters.items() if strName.startswith('rx.')], reverse=True)[0:5]
+    return 'rx ' + str(intReceived) + ' frames (' + ('%.2f' % (intReceived/fltSeconds)) + '/s' + \
+           ''.join([' ' + strCommand + ':' + str(intCount) for intCount, strCommand in listTop]) + '), ' + \
+           str(self.dictCounters.get('bytes.received', 0)) + ' bytes, garbage ' + str(self.dictCounters.get('bytes.garbage', 0)) + \
+           ' bytes, buffered max ' + str(self.intBuffered) + ' bytes, tx ' + str(self.total('tx.')) + ' frames' + \
+           ', parse ' + self.histogram('parse').summary() + ', dispatch ' + self.histogram('dispatch').summary() + \
+           ', command ' + self.histogram('command').summary() + ', round trip ' + self.histogram('roundtrip').summary() + \
+           ', ack ' + self.histogram('ack').summary() + ', retried ' + str(self.dictCounters.get('command.retry', 0)) + \
+           ', blocked ' + str(self.dictCounters.get('command.blocked', 0)) + ', failed ' + str(self.dictCounters.get('command.failed', 0))
+
+  def reset(self):
+    self.fltWindowStart = time.time()
+    self.dictCounters = {}
+    self.dictHistograms = {}
+    self.dictSendTime = {}
+    self.intBuffered = 0
+
+class DeviceStateCache:
+  # Write-through shadow of the state of the Domoticz devices.
+  # Updates that do not change the state of a device are dropped. A device that was updated less
+  # than DEVICE_COALESCE_TIME ago is not updated again right away, instead the new state is kept
+  # as pending and written by flush(), so a burst of updates results in a single final Update.
+  # The flush is scheduled under strKey for the moment the first pending state may be written.
+  # A device that changes all the time can be given a longer coalesce time with setCoalesceTime.
+
+  def __init__(self, objScheduler, strKey):
+    self.objScheduler = objScheduler
+    self.strKey = strKey
+    self.dictState = {}                      # Unit -> (nValue, sValue) as last written to Domoticz
+    self.dictPending = {}                    # Unit -> (nValue, sValue) not yet written to Domoticz
+    self.dictLastWrite = {}                  # Unit -> time of the last write
+    self.dictCoalesceTime = {}               # Unit -> coalesce time, for devices that do not use DEVICE_COALESCE_TIME
+
+  def setCoalesceTime(self, Unit, fltSeconds):
+    self.dictCoalesceTime[Unit] = fltSeconds
+
+  def update(self, Unit, nValue, sValue):
+    tupleState = (nValue, str(sValue))
+    if (Unit in self.dictPending):
+      if (self.dictState.get(Unit) == tupleState):
+        del self.dictPending[Unit]           # Back to what Domoticz already shows
+      else:
+        self.dictPending[Unit] = tupleState
+      return
+    if (Unit not in self.dictState):
+      if (Unit not in Devices):
+        return
+      self.dictState[Unit] = (Devices[Unit].nValue, Devices[Unit].sValue)
+    if (self.dictState[Unit] == tupleState):
+      return
+    if (time.time() - self.dictLastWrite.get(Unit, 0) < self.dictCoalesceTime.get(Unit, DEVICE_COALESCE_TIME)):
+      self.dictPending[Unit] = tupleState
+      if (self.objScheduler.scheduled(self.strKey) == False):
+        self.scheduleFlush()
+      return
+    self.write(Unit, tupleState)
+
+  def flush(self):
+    # Write the pending states of the devices that have not been updated recently
+    if (len(self.dictPending) == 0):
+      return
+    fltNow = time.time()
+    for Unit in list(self.dictPending):
+      if (fltNow - self.dictLastWrite.get(Unit, 0) >= self.dictCoalesceTime.get(Unit, DEVICE_COALESCE_TIME)):
+        self.write(Unit, self.dictPending.pop(Unit))
+    self.scheduleFlush()
+
+  def scheduleFlush(self):
+    if (len(self.dictPending) == 0):
+      self.objScheduler.cancel(self.strKey)
+      return
+    fltDue = min([self.dictLastWrite.get(Unit, 0) + self.dictCoalesceTime.get(Unit, DEVICE_COALESCE_TIME) for Unit in self.dictPending])
+    self.objScheduler.schedule(self.strKey, fltDue - time.time(), self.flush)
+
+  def pending(self):
+    return len(self.dictPending) > 0
+
+  def write(self, Unit, tupleState):
+    self.dictState[Unit] = tupleState
+    self.dictLastWrite[Unit] = time.time()
+    UpdateDevice(Unit, tupleState[0], tupleState[1])
+
+  def forget(self, Unit=None):
+    # Drop the shadow state, the next update reads the state from Domoticz again
+    if (Unit == None):
+      self.dictState.clear()
+      self.dictPending.clear()
+    else:
+      self.dictState.pop(Unit, None)
+      self.dictPending.pop(Unit, None)
+    self.scheduleFlush()
+
+class DiscoveryEngine:
+  # Finds receivers with the Onkyo discovery protocol.
+  # The ECN query is broadcast over a Domoticz UDP connection, so responses are handled by
+  # onMessage as soon as they arrive. Broadcasts are repeated by the scheduler with exponential
+  # backoff. fnFound is called with (IP address, model, port, region, MAC) for every receiver
+  # that responds.
+
+  def __init__(self, fnFound, objScheduler):
+    self.fnFound = fnFound
+    self.objScheduler = objScheduler
+    self.objConnection = None                # UDP connection used for broadcasting and receiving responses
+    self.objParser = eISCPParser()
+    self.fltInterval = DISCOVERY_INTERVAL    # Current interval between broadcasts
+
+  def start(self):
+    if (self.objConnection == None):
+      self.objConnection = Domoticz.Connection(Name="Onkyo Discovery", Transport="UDP/IP", Protocol="None", \
+                                               Address="255.255.255.255", Port=str(UDP_PORT))
+      self.objConnection.Listen()
+    self.fltInterval = DISCOVERY_INTERVAL
+    self.broadcast()
+
+  def stop(self):
+    self.objScheduler.cancel('discovery')
+    if (self.objConnection != None):
+      self.objConnection.Disconnect()
+      self.objConnection = None
+
+  def running(self):
+    return self.objConnection != None
+
+  def isConnection(self, Connection):
+    return (self.objConnection != None) and (Connection.Name == self.objConnection.Name)
+
+  def broadcast(self):
+    self.objConnection.Send(Message=createISCPFrame(MESSAGE_DISCOVER))
+    _log.debug('discovery', 'Discovery broadcast, repeated in %d seconds', self.fltInterval)
+    self.objScheduler.schedule('discovery', self.fltInterval, self.broadcast)
+    self.fltInterval = min(self.fltInterval*2, DISCOVERY_MAX_INTERVAL)
+
+  def onMessage(self, Connection, Data):
+    for strCommand, strMessage in self.objParser.feed(Data):
+      if (strCommand != 'ECN') or (strMessage == 'QSTN'):
+        continue                             # Not a response, for example our own broadcast
+      _log.debug('discovery', 'Discovery response from %s: %s', Connection.Address, strMessage)
+      listFields = strMessage.split('/')
+      if (len(listFields) < 4):
+        continue
+      self.fnFound(Connection.Address, listFields[0], listFields[1], listFields[2], listFields[3][0:12])
+
+class CommandQueue:
+  # Send scheduler for the connection with the receiver.
+  # Frames are send with at least fltInterval seconds in between. While a frame for one of the
+  # COMMAND_COALESCE commands is waiting in the queue a new value for that command replaces
+  # it, so the receiver only gets the latest volume level, preset or source. Frames that have to
+  # wait are send by a flush scheduled under strKey. A batch of frames queued with sendBatch goes
+  # out in a single write.
+  # The scheduler only runs on a heartbeat, which is at least a second, so that flush is only a
+  # fallback. The receiver echoes every command, and the echo of the last frame written means it
+  # is ready for the next one: echoed() lifts the interval and the flush from onMessage sends it.
+
+  def __init__(self, fltInterval, objScheduler, strKey, objMetrics):
+    self.objScheduler = objScheduler
+    self.strKey = strKey
+    self.objMetrics = objMetrics
+    self.objConnection = None                # The connection the frames are send on
+    self.fltInterval = fltInterval           # Minimum time between two frames
+    self.listQueue = []                      # Messages waiting to be send, in order
+    self.dictQueued = {}                     # Command -> index in listQueue for coalescing commands
+    self.fltLastSend = 0
+    self.intBatchEnd = 0                     # The frames in listQueue up to this index are send in one write
+    self.fnSent = None                       # Called with the messages of every write
+    self.strEcho = None                      # Command of the last frame written, until the receiver echoed it
+
+  def send(self, strMessage):
+    strCommand = strMessage[2:5]
+    if (strCommand in COMMAND_COALESCE):
+      intIndex = self.dictQueued.get(strCommand)
+      if (intIndex != None):
+        self.listQueue[intIndex] = strMessage  # Latest value wins, keep the original position
+        return
+      self.dictQueued[strCommand] = len(self.listQueue)
+    self.listQueue.append(strMessage)
+    self.flush()
+
+  def sendBatch(self, listMessages, blNow=False):
+    # Queue frames that must not be spread over the command interval, like the steps of a macro.
+    # With blNow the batch does not wait for the interval either, the receiver just answered.
+    for strMessage in listMessages:
+      intIndex = self.dictQueued.pop(strMessage[2:5], None)
+      if (intIndex != None) and (intIndex >= self.intBatchEnd):
+        self.listQueue[intIndex] = None      # The batch overrides a queued value, at its own position
+    self.listQueue = [strMessage for strMessage in self.listQueue if strMessage != None] + listMessages
+    self.intBatchEnd = len(self.listQueue)
+    self.dictQueued = {}
+    if (blNow == True):
+      self.fltLastSend = 0
+    self.flush()
+
+  def flush(self):
+    # Send the next queued frame(s), as far as the minimum interval allows
+    if (len(self.listQueue) == 0) or (self.objConnection == None):
+      return
+    fltNow = time.time()
+    if (fltNow - self.fltLastSend < self.fltInterval):
+      self.objScheduler.schedule(self.strKey, self.fltLastSend + self.fltInterval - fltNow, self.flush)
+      return
+    if (self.fltInterval > 0):
+      intCount = max(self.intBatchEnd, 1)
+    else:
+      intCount = len(self.listQueue)
+    self.intBatchEnd = max(self.intBatchEnd - intCount, 0)
+    self.objConnection.Send(Message=b''.join([createISCPFrame(strMessage) for strMessage in self.listQueue[0:intCount]]))
+    self.objMetrics.sent(self.objConnection.Name, self.listQueue[0:intCount])
+    if (self.fnSent != None):
+      self.fnSent(self.listQueue[0:intCount])
+    self.fltLastSend = fltNow
+    self.strEcho = self.listQueue[intCount-1][2:5]
+    del self.listQueue[0:intCount]
+    self.dictQueued = {}
+    for intIndex in range(0, len(self.listQueue)):
+      if (self.listQueue[intIndex][2:5] in COMMAND_COALESCE):
+        self.dictQueued[self.listQueue[intIndex][2:5]] = intIndex
+    if (len(self.listQueue) > 0):
+      self.objScheduler.schedule(self.strKey, self.fltInterval, self.flush)
+
+  def echoed(self):
+    # The receiver reported the command of the last frame, the next one does not have to wait
+    self.strEcho = None
+    self.fltLastSend = 0
+
+  def pending(self):
+    return len(self.listQueue) > 0
+
+  def clear(self):
+    self.listQueue = []
+    self.dictQueued = {}
+    self.intBatchEnd = 0
+    self.strEcho = None
+    self.objScheduler.cancel(self.strKey)
+
+class MacroEngine:
+  # Runs the macros of one receiver. A macro is a list of eISCP messages and delays ('500ms').
+  # The messages go out in as few writes as possible: everything up to and including the next
+  # MACRO_ACK_COMMANDS message is send as one batch, and the next batch only after the receiver
+  # reported the value that message set, or after MACRO_ACK_TIMEOUT. Only reports that come after
+  # the message was written count, the receiver also pushes its state when it powers on. The next
+  # batch does not wait for the command interval. So 'PWR01 SLI10 LMD04 MVL23' takes three writes
+  # (PWR01, SLI10, LMD04 MVL23) and the response time of the receiver, and no fixed delays.
+
+  def __init__(self, listMacros, objScheduler, strKey, objSendQueue):
+    self.dictMacros = dict(listMacros)       # Name -> list of ('send', message) and ('wait', seconds) steps
+    self.objScheduler = objScheduler
+    self.strKey = strKey
+    self.objSendQueue = objSendQueue
+    self.strName = None                      # Macro that is running
+    self.listSteps = []                      # Steps of the running macro that are not done yet
+    self.strAwait = None                     # Command the receiver has to report before the next batch
+    self.strAwaitMessage = None              # The message of that command, as queued
+    self.blAwaitSent = False                 # Has that message been written, reports before that do not count
+    self.fltStart = 0
+
+  def run(self, strName):
+    listSteps = self.dictMacros.get(strName)
+    if (listSteps == None):
+      return False
+    if (self.strName != None):
+      _log.info('Macro %s interrupted by macro %s', self.strName, strName)
+      self.stop()
+    _log.debug('commands', 'Macro %s started', strName)
+    self.strName = strName
+    self.listSteps = list(listSteps)
+    self.fltStart = time.time()
+    self.next()
+    return True
+
+  def stop(self):
+    self.objScheduler.cancel(self.strKey)
+    self.strName = None
+    self.listSteps = []
+    self.strAwait = None
+
+  def next(self, blAcknowledged=False):
+    # Send the next batch of messages, and wait for the receiver or the next delay
+    self.strAwait = None
+    listBatch = []
+    while (len(self.listSteps) > 0):
+      strStep, value = self.listSteps.pop(0)
+      if (strStep == 'wait'):
+        self.objScheduler.schedule(self.strKey, value, self.next)
+        break
+      listBatch.append(value)
+      if (value[2:5] in MACRO_ACK_COMMANDS) and (len(self.listSteps) > 0):
+        self.strAwait = value[2:5]
+        self.strAwaitMessage = value
+        self.blAwaitSent = False
+        self.objScheduler.schedule(self.strKey, MACRO_ACK_TIMEOUT, self.timeout)
+        break
+    if (len(listBatch) > 0):
+      self.objSendQueue.sendBatch(listBatch, blAcknowledged)
+    if (len(self.listSteps) == 0) and (self.strAwait == None) and (self.objScheduler.scheduled(self.strKey) == False):
+      _log.info('Macro %s send in %d ms', self.strName, (time.time()-self.fltStart)*1000)
+      self.strName = None
+
+  def sent(self, listMessages):
+    # Called by the send queue for every write while a report is awaited, the timeout starts now
+    if (self.blAwaitSent == False) and (self.strAwaitMessage in listMessages):
+      self.blAwaitSent = True
+      self.objScheduler.schedule(self.strKey, MACRO_ACK_TIMEOUT, self.timeout)
+
+  def received(self, strCommand, strMessage):
+    # Called for every frame from the receiver while a report is awaited
+    if (strCommand != self.strAwait) or (self.blAwaitSent == False):
+      return
+    strValue = self.strAwaitMessage[5:]
+    if (strMessage != 'N/A') and (COMMAND_VALUE.match(strValue) != None) and (strMessage.upper() != strValue.upper()):
+      return                                 # Not the state the macro set
+    _log.debug('commands', 'Macro %s: %s%s after %d ms', self.strName, strCommand, strMessage, (time.time()-self.fltStart)*1000)
+    self.objScheduler.cancel(self.strKey)
+    self.next(True)
+
+  def timeout(self):
+    _log.info('Macro %s: no answer for %s, continuing', self.strName, self.strAwait)
+    self.next()
+
+class CommandTracker:
+  # Keeps the commands that were send to the receiver until it reports the state they set.
+  # A report completes the command and its round trip time is recorded, 'N/A' means the receiver
+  # did not accept it (a zone that is off, a source it does not have). A command that is not
+  # reported within COMMAND_ACK_TIMEOUT is send again, up to COMMAND_RETRIES times, and then
+  # given up on. Every outcome is passed to fnReport(message, result, seconds, attempts), with
+  # result 'ok', 'blocked' or 'failed'. Only one command per ISCP command is kept, a newer
+  # value replaces the one that is in flight.
+
+  def __init__(self, tupleCommands, objScheduler, strKey, objSendQueue, objMetrics, fnReport):
+    self.setCommands = set(tupleCommands)    # ISCP commands that are tracked, the receiver reports the state of each
+    self.objScheduler = objScheduler
+    self.strKey = strKey
+    self.objSendQueue = objSendQueue
+    self.objMetrics = objMetrics
+    self.fnReport = fnReport
+    self.dictInFlight = {}                   # Command -> (message, time it was send, attempts)
+
+  def sent(self, listMessages):
+    # Called by the send queue for every write
+    fltNow = time.time()
+    for strMessage in listMessages:
+      strCommand = strMessage[2:5]
+      if (strCommand not in self.setCommands) or (strMessage[5:] == 'QSTN'):
+        continue
+      tupleEntry = self.dictInFlight.get(strCommand)
+      if (tupleEntry != None) and (tupleEntry[0] == strMessage):
+        self.dictInFlight[strCommand] = (strMessage, fltNow, tupleEntry[2])   # A retry
+      else:
+        self.dictInFlight[strCommand] = (strMessage, fltNow, 1)
+    self.scheduleTimeout()
+
+  def received(self, strCommand, strMessage):
+    # Called for every frame from the receiver of a command that is in flight
+    strSent, fltSent, intAttempts = self.dictInFlight[strCommand]
+    if (strMessage == 'N/A'):
+      strResult = 'blocked'
+      self.objMetrics.count('command.blocked')
+    elif (COMMAND_VALUE.match(strSent[5:]) == None) or (strMessage.upper() == strSent[5:].upper()):
+      strResult = 'ok'
+    else:
+      return                                 # The state is not (yet) what the command set
+    del self.dictInFlight[strCommand]
+    fltSeconds = time.time() - fltSent
+    if (strResult == 'ok'):
+      self.objMetrics.observe('ack', fltSeconds)
+    self.fnReport(strSent, strResult, fltSeconds, intAttempts)
+    self.scheduleTimeout()
+
+  def timeout(self):
+    fltNow = time.time()
+    for strCommand, (strMessage, fltSent, intAttempts) in list(self.dictInFlight.items()):
+      if (fltNow - fltSent < COMMAND_ACK_TIMEOUT):
+        continue
+      if (intAttempts <= COMMAND_RETRIES):
+        _log.debug('commands', 'No report of %s after %d ms, sending it again', strMessage[2:], (fltNow-fltSent)*1000)
+        self.objMetrics.count('command.retry')
+        self.dictInFlight[strCommand] = (strMessage, fltNow, intAttempts+1)
+        self.objSendQueue.send(strMessage)
+      else:
+        del self.dictInFlight[strCommand]
+        self.objMetrics.count('command.failed')
+        self.fnReport(strMessage, 'failed', fltNow-fltSent, intAttempts)
+    self.scheduleTimeout()
+
+  def scheduleTimeout(self):
+    # A task that is already scheduled is due no later than the oldest command, timeout() reschedules
+    if (len(self.dictInFlight) == 0):
+      self.objScheduler.cancel(self.strKey)
+      return
+    if (self.objScheduler.scheduled(self.strKey) == True):
+      return
+    fltDue = min([fltSent for strMessage, fltSent, intAttempts in self.dictInFlight.values()]) + COMMAND_ACK_TIMEOUT
+    self.objScheduler.schedule(self.strKey, max(fltDue - time.time(), 0), self.timeout)
+
+  def clear(self, listQueued=()):
+    # The connection is gone, the commands in flight and the ones still queued will not be answered
+    fltNow = time.time()
+    for strMessage, fltSent, intAttempts in list(self.dictInFlight.values()):
+      self.fnReport(strMessage, 'failed', fltNow-fltSent, intAttempts)
+    for strMessage in listQueued:
+      if (strMessage[2:5] in self.setCommands) and (strMessage[5:] != 'QSTN'):
+        self.fnReport(strMessage, 'failed', 0, 0)
+    self.dictInFlight = {}
+    self.objScheduler.cancel(self.strKey)
+
+class CoverArt:
+  # Reassembles the cover art of the network and USB sources from NJA frames. The parameter of NJA
+  # is the image type ('0' BMP, '1' JPEG, '2' URL, 'n' no image), the packet ('0' first, '1' next,
+  # '2' last, '-' the only one) and the image as hexadecimal text. A complete image is written to
+  # strFile plus the extension of its type, unless the file already holds an image with its hash.
+
+  def __init__(self, strFile):
+    self.strFile = strFile                   # Path of the image file, without extension
+    self.strType = None                      # Type of the image that is being received
+    self.bImage = bytearray()                # The part of that image received so far
+    self.dictHash = {}                       # File -> SHA-1 of what is in it
+
+  def feed(self, strMessage):
+    # Returns the file or URL of the cover art once it is complete, '' if there is none
+    strType = strMessage[0:1]
+    strPacket = strMessage[1:2]
+    if (strType == '2'):
+      return strMessage[2:]
+    if (strType == 'n'):
+      return ''
+    if (strType not in ART_TYPES):
+      return None
+    if (strPacket in ('0', '-')):
+      self.strType = strType
+      self.bImage = bytearray()
+    elif (self.strType != strType):
+      return None                            # We missed the first packet of this image
+    try:
+      self.bImage += bytes.fromhex(strMessage[2:])
+    except ValueError:
+      self.strType = None
+      return None
+    if (len(self.bImage) > ART_MAX_SIZE):
+      _log.debug('dispatch', 'Cover art larger than %d bytes dropped', ART_MAX_SIZE)
+      self.strType = None
+      self.bImage = bytearray()
+      return None
+    if (strPacket not in ('2', '-')):
+      return None
+    bImage = bytes(self.bImage)
+    self.strType = None
+    self.bImage = bytearray()
+    return self.write(self.strFile + ART_TYPES[strType], bImage)
+
+  def write(self, strFile, bImage):
+    strHash = hashlib.sha1(bImage).hexdigest()
+    if (strFile not in self.dictHash) and (os.path.isfile(strFile) == True):
+      try:
+        with open(strFile, 'rb') as f:
+          self.dictHash[strFile] = hashlib.sha1(f.read()).hexdigest()
+      except IOError:
+        pass
+    if (self.dictHash.get(strFile) == strHash):
+      return strFile                         # Same art as before, the file is not written again
+    try:
+      with open(strFile + '.tmp', 'wb') as f:
+        f.write(bImage)
+      os.replace(strFile + '.tmp', strFile)
+    except (IOError, OSError):
+      _log.error('Could not write the cover art: %s', strFile)
+      return None
+    self.dictHash[strFile] = strHash
+    _log.debug('dispatch', 'Cover art written to %s, %d bytes', strFile, len(bImage))
+    return strFile
+
+class StateModel:
+  # Versioned state of one receiver: (zone, key) -> value. Every change gets the next version
+  # number of the receiver, so a subscriber can tell which of two values is the newest.
+
+  def __init__(self):
+    self.intVersion = 0
+    self.dictValues = {}                     # (zone, key) -> value
+    self.dictVersions = {}                   # (zone, key) -> version of the value
+
+  def set(self, strZone, strKey, value, blEvent=False):
+    # Returns the version of the new value, or None if the value did not change and it is not an event
+    tupleKey = (strZone, strKey)
+    if (blEvent == False) and (tupleKey in self.dictValues) and (self.dictValues[tupleKey] == value):
+      return None
+    self.intVersion += 1
+    self.dictValues[tupleKey] = value
+    self.dictVersions[tupleKey] = self.intVersion
+    return self.intVersion
+
+  def items(self):
+    for tupleKey, value in self.dictValues.items():
+      yield tupleKey[0], tupleKey[1], value, self.dictVersions[tupleKey]
+
+class StateFeed:
+  # Local push channel for the state of the receivers.
+  # Clients connect to a Domoticz TCP listener on the Mode3 port and get one JSON object per line
+  # for every change: {"receiver": MAC, "zone": "main", "key": "volume", "value": 40, "version": 7}.
+  # A client can send {"subscribe": {"receivers": [...], "zones": [...], "keys": [...]}} to
+  # limit what it gets, every list is optional. After connecting and after every subscribe the
+  # client first gets the current state that matches its filter.
+
+  def __init__(self):
+    self.objListener = None
+    self.dictStates = {}                     # MAC -> StateModel of every receiver
+    self.dictClients = {}                    # Address:port -> [connection, filter, receive buffer]
+
+  def start(self, intPort):
+    self.objListener = Domoticz.Connection(Name=FEED_NAME, Transport="TCP/IP", Protocol="None", Port=str(intPort))
+    self.objListener.Listen()
+    _log.info('State feed listening on port %d', intPort)
+
+  def stop(self):
+    for listClient in list(self.dictClients.values()):
+      listClient[0].Disconnect()
+    self.dictClients = {}
+    if (self.objListener != None):
+      self.objListener.Disconnect()
+      self.objListener = None
+
+  def isConnection(self, Connection):
+    return (self.objListener != None) and (Connection.Name == FEED_NAME)
+
+  def register(self, strMAC, objState):
+    self.dictStates[strMAC] = objState
+
+  def clientKey(self, Connection):
+    return str(Connection.Address) + ':' + str(Connection.Port)
+
+  def onConnect(self, Connection, Status, Description):
+    if (Status != 0):
+      return
+    if (Connection.Address not in FEED_LOCAL_ADDRESSES):
+      _log.info('State feed connection from %s refused', Connection.Address)
+      Connection.Disconnect()
+      return
+    _log.debug('connection', 'State feed client %s connected', self.clientKey(Connection))
+    self.dictClients[self.clientKey(Connection)] = [Connection, {}, b'']
+    self.sendSnapshot(Connection, {})
+
+  def onMessage(self, Connection, Data):
+    listClient = self.dictClients.get(self.clientKey(Connection))
+    if (listClient == None):
+      return
+    listClient[2] += Data
+    while (b'\n' in listClient[2]):
+      bLine, listClient[2] = listClient[2].split(b'\n', 1)
+      self.request(listClient, bLine)
+    if (len(listClient[2]) > FEED_MAX_LINE):
+      listClient[2] = b''
+      self.sendEvents(Connection, [{'error': 'request too long'}])
+
+  def onDisconnect(self, Connection):
+    self.dictClients.pop(self.clientKey(Connection), None)
+
+  def request(self, listClient, bLine):
+    if (bLine.strip() == b''):
+      return
+    dictFilter = None
+    try:
+      dictRequest = json.loads(bLine.decode('utf-8'))
+      if (isinstance(dictRequest, dict) == True):
+        dictFilter = self.parseFilter(dictRequest.get('subscribe'))
+    except ValueError:
+      pass
+    if (dictFilter == None):
+      self.sendEvents(listClient[0], [{'error': 'expected {"subscribe": {"receivers": [...], "zones": [...], "keys": [...]}}'}])
+      return
+    listClient[1] = dictFilter
+    self.sendSnapshot(listClient[0], dictFilter)
+
+  def parseFilter(self, dictSubscribe):
+    # The filter of a subscribe request, or None when it is not an object of lists of strings
+    if (isinstance(dictSubscribe, dict) == False):
+      return None
+    dictFilter = {}
+    for strField, listValues in dictSubscribe.items():
+      if (strField not in ('receivers', 'zones', 'keys')) or (isinstance(listValues, list) == False):
+        return None
+      for strValue in listValues:
+        if (isinstance(strValue, str) == False):
+          return None
+      dictFilter[strField] = set(listValues)
+    return dictFilter
+
+  def matches(self, dictFilter, strMAC, strZone, strKey):
+    return ((strMAC in dictFilter.get('receivers', (strMAC,))) and (strZone in dictFilter.get('zones', (strZone,))) and \
+            (strKey in dictFilter.get('keys', (strKey,))))
+
+  def sendSnapshot(self, Connection, dictFilter):
+    listEvents = []
+    for strMAC, objState in self.dictStates.items():
+      for strZone, strKey, value, intVersion in objState.items():
+        if (self.matches(dictFilter, strMAC, strZone, strKey) == True):
+          listEvents.append({'receiver': strMAC, 'zone': strZone, 'key': strKey, 'value': value, 'version': intVersion})
+    self.sendEvents(Connection, listEvents)
+
+  def sendEvents(self, Connection, listEvents):
+    if (len(listEvents) > 0):
+      Connection.Send(Message=''.join([json.dumps(dictEvent) + '\n' for dictEvent in listEvents]).encode('utf-8'))
+
+  def publish(self, strMAC, strZone, strKey, value, intVersion):
+    # Send a change to the clients that subscribed to it, the JSON is only built if there is one.
+    # This runs for every frame of every receiver, a client that fails here is dropped.
+    bLine = None
+    for strClient, (objConnection, dictFilter, bBuffer) in list(self.dictClients.items()):
+      try:
+        if (self.matches(dictFilter, strMAC, strZone, strKey) == True):
+          if (bLine == None):
+            bLine = (json.dumps({'receiver': strMAC, 'zone': strZone, 'key': strKey, 'value': value, 'version': intVersion}) + '\n').encode('utf-8')
+          objConnection.Send(Message=bLine)
+      except Exception as err:
+        _log.error('State feed client %s dropped: %s', strClient, str(err))
+        self.dictClients.pop(strClient, None)
+        objConnection.Disconnect()
+
+class ModelWorker:
+  # Parses the receiver information (NRI) of the receivers on a thread of its own. Parsing the
+  # XML from onMessage locks up Domoticz, and a large XML would block the plugin anyway.
+  # feed() hands the chunks of the XML to the thread as they arrive, the finished ReceiverModel
+  # comes back through a queue that the plugin drains with results() from onHeartbeat. The thread
+  # does not use the Domoticz API, errors are returned as text and logged by the plugin.
+
+  def __init__(self):
+    self.objRequests = queue.Queue()         # (MAC, chunk, first, last) to parse, None stops the thread
+    self.objResults = queue.Queue()          # (MAC, model or None, error, seconds) of every request
+    self.objThread = None
+    self.intPending = 0                      # Requests of which the result has not been drained
+
+  def feed(self, strMAC, bChunk, blFirst, blLast):
+    if (self.objThread == None):
+      self.objThread = threading.Thread(name='Onkyo NRI', target=self.run, daemon=True)
+      self.objThread.start()
+    if (blLast == True):
+      self.intPending += 1
+    self.objRequests.put((strMAC, bChunk, blFirst, blLast))
+
+  def run(self):
+    dictBuilders = {}                        # MAC -> ModelBuilder of the XML that is arriving
+    while True:
+      tupleRequest = self.objRequests.get()
+      if (tupleRequest == None):
+        return
+      strMAC, bChunk, blFirst, blLast = tupleRequest
+      if (blFirst == True):
+        dictBuilders[strMAC] = ModelBuilder()  # Also drops what was left of an XML that never completed
+      objBuilder = dictBuilders[strMAC]
+      objBuilder.feed(bChunk)
+      if (blLast == True):
+        del dictBuilders[strMAC]
+        self.objResults.put((strMAC,) + objBuilder.close())
+
+  def pending(self):
+    return self.intPending > 0
+
+  def results(self):
+    # The results that are ready, without waiting for the others
+    while (self.intPending > 0):
+      try:
+        tupleResult = self.objResults.get_nowait()
+      except queue.Empty:
+        return
+      self.intPending -= 1
+      yield tupleResult
+
+  def stop(self):
+    # Domoticz waits for the threads of a plugin when it stops it
+    if (self.objThread != None):
+      self.objRequests.put(None)
+      self.objThread.join(1.0)
+      self.objThread = None
+
+class ModelBuilder:
+  # Builds a ReceiverModel from the XML of a receiver while it arrives. Only the attributes the
+  # model needs are kept, every element is cleared as soon as it has been read.
+
+  def __init__(self):
+    self.objParser = XMLTree.XMLPullParser(events=('end',))
+    self.strModel = None
+    self.strFirmware = ''
+    self.listZones = []
+    self.listSelectors = []
+    self.listPresets = []
+    self.listModes = []
+    self.listControls = []
+    self.strError = None                     # First error, the rest of the XML is ignored after one
+    self.fltTime = 0                         # Seconds spend parsing
+    self.blStarted = False                   # Has the first '<' been seen, anything in front of it is dropped
+
+  def feed(self, bChunk):
+    if (self.strError != None):
+      return
+    if (self.blStarted == False):
+      intStart = bChunk.find(b'<')
+      if (intStart == -1):
+        return
+      bChunk = bChunk[intStart:]
+      self.blStarted = True
+    fltStart = time.perf_counter()
+    try:
+      self.objParser.feed(bChunk)
+      self.readEvents()
+    except (XMLTree.ParseError, TypeError, ValueError) as e:
+      self.strError = type(e).__name__ + ': ' + str(e)
+    self.fltTime += time.perf_counter() - fltStart
+
+  def readEvents(self):
+    for strEvent, element in self.objParser.read_events():
+      strTag = element.tag
+      if (strTag == 'zone'):
+        self.listZones.append((int(element.get('id')), int(element.get('value')) == 1, element.get('name'), int(element.get('volmax'))))
+      elif (strTag == 'selector'):
+        self.listSelectors.append((element.get('id'), element.get('name')))
+      elif (strTag == 'preset'):
+        self.listPresets.append((element.get('id'), element.get('band'), element.get('name')))
+      elif (strTag == 'control'):
+        strId = element.get('id', '')
+        if (strId[0:3] == 'LMD'):
+          self.listModes.append((element.get('code'), strId[4:]))
+        elif (element.get('min') != None) and (element.get('value', '1') == '1'):
+          self.readControl(strId, element)     # value="0" is a control this receiver does not have
+      elif (strTag == 'model'):
+        self.strModel = element.text
+      elif (strTag == 'firmwareversion'):
+        self.strFirmware = element.text or ''
+      element.clear()                        # Also drops the (cleared) children of a list
+
+  def readControl(self, strId, element):
+    # A tone or level control, one the plugin does not understand is left out
+    try:
+      self.listControls.append((strId, int(element.get('zone', '1')), int(element.get('min')), int(element.get('max')), \
+                                max(int(element.get('step', '1')), 1)))
+    except ValueError:
+      pass
+
+  def close(self):
+    # Returns (model, None, seconds), or (None, error, seconds) if the XML could not be used
+    if (self.strError == None):
+      try:
+        self.objParser.close()
+        self.readEvents()
+      except (XMLTree.ParseError, TypeError, ValueError) as e:
+        self.strError = type(e).__name__ + ': ' + str(e)
+    if (self.strError == None) and (self.strModel == None):
+      self.strError = 'no model in the receiver information'
+    if (self.strError != None):
+      return (None, self.strError, self.fltTime)
+    return (ReceiverModel(self.strModel, self.strFirmware, tuple(self.listZones), tuple(self.listSelectors), \
+                          tuple(self.listPresets), tuple(self.listModes), tuple(self.listControls)), None, self.fltTime)
+
+class ReceiverZone:
+  __slots__ = ('intId', 'blEnabled', 'strName', 'intVolMax')
+
+  def __init__(self, intId, blEnabled, strName, intVolMax):
+    self.intId = intId                       # Zone number, 1 is the main zone
+    self.blEnabled = blEnabled               # Does the receiver have this zone
+    self.strName = strName
+    self.intVolMax = intVolMax               # Maximum volume of the zone, 0 if unknown
+
+class ReceiverModel:
+  # The parts of the NRI XML of the receiver that are used by the plugin, with lookup tables
+  # compiled from it, so that incomming status frames and outgoing commands do not have to
+  # search the XML tree. The XML tree itself is not kept. snapshot() returns the model as a
+  # tuple of plain values, which is what is cached on disk.
+  __slots__ = ('strModel', 'strFirmware', 'listZones', 'listSelectors', 'listPresets', 'listModes', 'listControls', \
+               'dictSelectorName', 'dictSelectorId', 'dictPresetName', 'dictPresetId', 'dictModeName', 'dictModeCode', 'dictControls')
+
+  def __init__(self, strModel, strFirmware, tupleZones, tupleSelectors, tuplePresets, tupleModes, tupleControls):
+    self.strModel = strModel                 # Model name of the receiver
+    self.strFirmware = strFirmware           # Firmware version of the receiver
+    self.listZones = [ReceiverZone(*tupleZone) for tupleZone in tupleZones]
+    self.listSelectors = tupleSelectors      # ((id, name), ...) in XML order
+    self.listPresets = tuplePresets          # ((id, band, name), ...) in XML order
+    self.listModes = tupleModes              # ((code, name), ...) of the listening modes in XML order
+    self.listControls = tupleControls        # ((id, zone, min, max, step), ...) of the tone and level controls
+    self.dictSelectorName = {}               # Selector id (upper case) -> selector name
+    self.dictSelectorId = {}                 # Selector name -> selector id (upper case)
+    self.dictPresetName = {}                 # Preset id (upper case) -> level name of the tuner preset device
+    self.dictPresetId = {}                   # Level name of the tuner preset device -> preset id (upper case)
+    self.dictModeName = {}                   # Listening mode code (upper case) -> listening mode name
+    self.dictModeCode = {}                   # Listening mode name -> listening mode code
+    self.dictControls = {}                   # (control id, zone) -> (min, max, step)
+    for strId, strName in self.listSelectors:
+      self.dictSelectorName[strId.upper()] = strName
+      self.dictSelectorId.setdefault(strName, strId.upper())
+    for strId, strBand, strName in self.listPresets:
+      strName = presetLevelName(strId, strName)
+      self.dictPresetName[strId.upper()] = strName
+      self.dictPresetId.setdefault(strName, strId.upper())
+    for strCode, strName in self.listModes:
+      self.dictModeName.setdefault(strCode.upper(), strName)
+      self.dictModeCode.setdefault(strName, strCode)
+    for strId, intZone, intMin, intMax, intStep in self.listControls:
+      self.dictControls[(strId, intZone)] = (intMin, intMax, intStep)
+
+  @staticmethod
+  def fromSnapshot(tupleSnapshot):
+    return ReceiverModel(*tupleSnapshot)
+
+  def snapshot(self):
+    tupleZones = tuple([(zone.intId, zone.blEnabled, zone.strName, zone.intVolMax) for zone in self.listZones])
+    return (self.strModel, self.strFirmware, tupleZones, self.listSelectors, self.listPresets, self.listModes, self.listControls)
+
+  def zone(self, intId):
+    # Returns the zone with this id if the receiver has it, None otherwise
+    for zone in self.listZones:
+      if (zone.intId == intId) and (zone.blEnabled == True):
+        return zone
+    return None
+
+class Receiver:
+  # Everything the plugin knows about and does with one receiver: its connection, frame parser,
+  # send queue, device state cache and model. The units of its devices start at intUnitBase+1.
+  # Everything that has to happen later runs as a task of the shared scheduler, keyed by the MAC.
+
+  def __init__(self, strMAC, intUnitBase, fltCommandInterval, objScheduler, objMetrics, objFeed, listMacros, objModelWorker):
+    self.intState = ReceiverState.LOST       # Where the receiver is in its life cycle
+    self.strMAC = strMAC                     # MAC address of the receiver
+    self.intUnitBase = intUnitBase           # Unit numbers of this receiver are intUnitBase + MAINPOWER etc.
+    self.objScheduler = objScheduler         # Runs the reconnect, XML, state query, keepalive and flush tasks
+    self.objMetrics = objMetrics             # Hot path counters and timings
+    self.objFeed = objFeed                   # Publishes the changes of objState
+    self.objModelWorker = objModelWorker     # Builds objModel from the XML of the receiver, off the plugin thread
+    self.objState = StateModel()             # Decoded state of the zones, as published on the state feed
+    self.objConnection = None                # TCP connection with the receiver
+    self.intReconnectAttempts = 0            # Number of failed connection attempts since the last successful one
+    self.intModelState = ModelState.UNKNOWN  # Where the receiver information is, objModel may already be cached
+    self.dictStateQueries = {}               # Command -> QSTN message for state queries that are not yet answered
+    self.fltStateQueryTime = 0               # When the state queries were last send
+    self.intStateQueryRetries = 0
+    self.fltLastReceive = 0                  # When we last received data from the receiver
     self.strIPAddress = ''                   # The IP address of the Onkyo Receiver
     self.strPort = ''                        # Contains the TCP port number to connect to
-    self.blDebug = False                     # Is debugging turned on
-    self.strInputBuffer = ''                 # In this buffer we store incomming data
-    self.bInputBuffer = b''
-    self.XMLRoot = None                      # Used to store the XML configuration data of the reciever
-    self.intMainMaxVolume = 80
-    self.intZone2MaxVolume = 80
+    self.objParser = eISCPParser(self.streamFrame)   # Splits the incomming data into eISCP frames
+    self.objDeviceCache = DeviceStateCache(objScheduler, self.taskKey('devices'))   # Last known state of the Domoticz devices
+    self.objSendQueue = CommandQueue(fltCommandInterval, objScheduler, self.taskKey('send'), objMetrics)   # Outgoing commands
+    self.objMacros = MacroEngine(listMacros, objScheduler, self.taskKey('macro'), self.objSendQueue)
+    self.objTracker = None                   # Commands waiting for the receiver to report their state, set below
+    self.listMacroNames = [strName for strName, listSteps in listMacros]   # Levels of the macro selector, in order
+    self.objModel = None                     # ReceiverModel compiled from the XML of the receiver or loaded from the cache
+    self.strModel = ''                       # Model as reported by the discovery response
+    self.strRegion = ''
+    self.dictMaxVolume = {}                  # Maximum receiver volume per volume device
+    self.dictHandlers = {}                   # Maps a 3 letter ISCP command to a (handler, arguments) tuple
+    self.dictCommands = {}                   # Maps a unit to a (command function, arguments) tuple
+    self.dictCommandZones = {'LMD': 'main', 'PRS': 'main'}   # ISCP command -> zone, for the commands that are tracked
+    self.dictUnitZones = {MAINLISTENINGMODE: 'main', TUNERPRESETS: 'main'}   # Unit offset -> zone, for commands that are not send
+    for objZone in ZONES:
+      self.dictMaxVolume[self.unit(objZone.intVolumeUnit)] = 80
+      for intOffset in [objZone.intPowerUnit, objZone.intSourceUnit, objZone.intVolumeUnit] + \
+                       [objControl.intUnit for objControl in objZone.listControls]:
+        self.dictUnitZones[intOffset] = objZone.strName
+      for strCommand in (objZone.strPower, objZone.strMute, objZone.strVolume, objZone.strSource):
+        self.dictCommandZones[strCommand] = objZone.strName
+      for objControl in objZone.listControls:
+        self.dictCommandZones[objControl.strCommand] = objZone.strName
+      self.registerHandler(objZone.strPower, self.handlePower, self.unit(objZone.intPowerUnit), objZone.strName)
+      self.registerHandler(objZone.strMute, self.handleMute, self.unit(objZone.intVolumeUnit), objZone.strName)
+      self.registerHandler(objZone.strVolume, self.handleVolume, self.unit(objZone.intVolumeUnit), objZone.strName)
+      self.registerHandler(objZone.strSource, self.handleSource, self.unit(objZone.intSourceUnit), objZone.strName)
+      self.registerCommand(objZone.intPowerUnit, self.commandPower, objZone)
+      self.registerCommand(objZone.intVolumeUnit, self.commandVolume, objZone)
+      self.registerCommand(objZone.intSourceUnit, self.commandSource, objZone)
+      dictControls = {}                      # Prefix -> ControlCommands, for every command of the zone
+      for objControl in objZone.listControls:
+        dictControls.setdefault(objControl.strCommand, {})[objControl.strPrefix] = objControl
+        self.registerCommand(objControl.intUnit, self.commandControl, objControl)
+      for strCommand, dictPrefixes in dictControls.items():
+        self.registerHandler(strCommand, self.handleControl, dictPrefixes, objZone.strName)
+    self.registerHandler('LMD', self.handleListeningMode, self.unit(MAINLISTENINGMODE), 'main')
+    self.registerHandler('PRS', self.handlePreset, self.unit(TUNERPRESETS), 'main')
+    self.registerHandler('NRI', self.handleReceiverInformation)
+    for strCommand, strKey, intOffset, strName in METADATA:
+      self.registerHandler(strCommand, self.handleMetadata, strKey, intOffset, strName)
+    self.registerHandler('NTM', self.handlePlayTime)
+    self.registerHandler('NJA', self.handleCoverArt)
+    self.objDeviceCache.setCoalesceTime(self.unit(METADATA_TIME), METADATA_TIME_INTERVAL)
+    self.objCoverArt = CoverArt(os.path.join(Parameters["HomeFolder"], 'Onkyo-' + strMAC + '-art'))
+    self.registerCommand(MAINLISTENINGMODE, self.commandListeningMode)
+    self.registerCommand(TUNERPRESETS, self.commandPreset)
+    self.registerCommand(MACROS, self.commandMacro)
+    self.objTracker = CommandTracker(tuple(self.dictCommandZones), objScheduler, self.taskKey('ack'), self.objSendQueue, objMetrics, \
+                                     self.commandResult)
+    self.objSendQueue.fnSent = self.framesSent
+    objFeed.register(strMAC, self.objState)
     return
 
-  def onStart(self):
-    if Parameters["Mode6"] == "Debug":
-      self.blDebug = True
-      Domoticz.Debugging(1)
-    
-    if (self.blDebug ==  True):
-      Domoticz.Log("Onkyo: onStart called")
-    Domoticz.Heartbeat(2)                   # Lower hartbeat interval, to speed up the initialization. 
+  def unit(self, intOffset):
+    # Domoticz unit number of a device of this receiver
+    return self.intUnitBase + intOffset
 
-  def onStop(self):
-    if (self.blDebug ==  True):
-      Domoticz.Log("Onkyo: onStop called")
+  def registerHandler(self, strCommand, fnHandler, *args):
+    # Register the function that processes incomming frames for an ISCP command.
+    # The handler is called as fnHandler(strMessage, *args)
+    self.dictHandlers[strCommand] = (fnHandler, args)
+
+  def registerCommand(self, intOffset, fnCommand, *args):
+    # Register the function that handles onCommand for a device of this receiver.
+    # It is called as fnCommand(Unit, Command, Level, *args)
+    self.dictCommands[self.unit(intOffset)] = (fnCommand, args)
+
+  def taskKey(self, strTask):
+    # Scheduler key of a task of this receiver
+    return self.strMAC + ':' + strTask
+
+  def connected(self):
+    return self.intState >= ReceiverState.LOADING
+
+  def setState(self, strZone, strKey, value, blEvent=False):
+    # With blEvent the value is published even if it did not change, for outcomes like 'command'
+    intVersion = self.objState.set(strZone, strKey, value, blEvent)
+    if (intVersion != None):
+      self.objFeed.publish(self.strMAC, strZone, strKey, value, intVersion)
 
   def onConnect(self, Connection, Status, Description):
-    if (self.blDebug ==  True):
-      Domoticz.Log("onConnect called")
-    self.blConnected = True                 # We are now connected
+    _log.debug('connection', 'onConnect called for %s, status %s', self.strMAC, Status)
+    if (Status != 0):
+      _log.info('Connecting to receiver %s failed: %s', self.strMAC, Description)
+      self.connectionLost()
+      return
+    self.intState = ReceiverState.LOADING    # We are now connected
+    self.intReconnectAttempts = 0
+    self.setState('receiver', 'connected', True)
+    self.fltLastReceive = time.time()
+    self.objScheduler.schedule(self.taskKey('keepalive'), KEEPALIVE_INTERVAL, self.keepAlive)
+    if (self.intModelState == ModelState.UNKNOWN):
+      self.requestReceiverInformation()
+    if (self.objModel != None):
+      # The devices are known, from the cache or from before a reconnect, we only need the states
+      self.getInitialStates()
 
-  def onMessage(self, Connection, Data, Status, Extra):
-    if (self.blDebug ==  True):
-      Domoticz.Log("onMessage called")
-      Domoticz.Log("We received "+str(len(Data))+" bytes of data")
-    self.bInputBuffer = b''.join([self.bInputBuffer, Data])       # We add the received data to the inputbuffer.
-    while (self.checkInputBuffer() == True):                      # Check if we have one or more complete frames in the input buffer
-      if (self.blDebug ==  True):
-        Domoticz.Log('We have a eISCP frame to process')
-      self.processeISCPFrame()
+  def onMessage(self, Connection, Data):
+    self.fltLastReceive = time.time()
+    intGarbage = self.objParser.intGarbage
+    blMetrics = self.objMetrics.blEnabled
+    if (blMetrics == True):
+      fltStart = time.perf_counter()
+      fltDispatch = 0
+    for strCommand, strMessage in self.objParser.feed(Data):   # Process every complete frame in the input buffer
+      _log.debug('framing', 'eISCP frame: %s %.64s', strCommand, strMessage)
+      if (blMetrics == True):
+        self.objMetrics.received(Connection.Name, strCommand)
+        fltFrame = time.perf_counter()
+        self.processeISCPFrame(strCommand, strMessage)
+        fltFrame = time.perf_counter() - fltFrame
+        self.objMetrics.observe('dispatch', fltFrame)
+        fltDispatch += fltFrame
+      else:
+        self.processeISCPFrame(strCommand, strMessage)
+    if (blMetrics == True):
+      self.objMetrics.observe('parse', time.perf_counter() - fltStart - fltDispatch)
+      self.objMetrics.count('bytes.received', len(Data))
+      self.objMetrics.count('bytes.garbage', self.objParser.intGarbage - intGarbage)
+      self.objMetrics.buffered(self.objParser.buffered())
+    self.objDeviceCache.flush()
+    self.objSendQueue.flush()                # The receiver answered, send the next queued command
+    if (self.objParser.intGarbage != intGarbage):
+      _log.debug('framing', 'We had garbage in the input buffer, got rid of: %d bytes.', self.objParser.intGarbage-intGarbage)
 
   def onCommand(self, Unit, Command, Level, Hue):
-    if (self.blDebug ==  True):
-      Domoticz.Log("Onkyo: onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
-
-    if (Unit==MAINPOWER):
-      # Main Power
-      if str(Command)=='On':
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_POWER+'01'))
-      if str(Command)=='Off':
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_POWER+'00'))
-
-    if (Unit==MAINVOLUME):
-      # Main Volume
-      if (Command=='Set Level'):
-        strVolume = hex(int((self.intMainMaxVolume/100)*Level))[2:]
-        if len(strVolume) == 1:
-          strVolume = '0'+strVolume
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_VOLUME+strVolume))
-      if (Command=='On'):
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_MUTE+'00'))
-        #Unmute
-      if (Command=='Off'):
-        #Mute
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_MUTE+'01'))
-
-    if (Unit==MAINSOURCE):
-      #Input Selector
-      dictOptions = Devices[MAINSOURCE].Options
-      listLevelNames = dictOptions['LevelNames'].split('|')
-      strSelectedName = listLevelNames[int(int(Level)/10)] 
-      if (self.blDebug ==  True):
-        Domoticz.Log('Main Source Selected: '+strSelectedName)
-      for selector in self.XMLRoot.find('device').find('selectorlist'):
-        if (selector.get('name')==strSelectedName):
-          strId = selector.get('id').upper()
-          self.objConnection.Send(Message=createISCPFrame(MESSAGE_SOURCE+strId))
-
-    if (Unit==MAINLISTENINGMODE):
-      #Listening Mode Selector
-      dictOptions = Devices[MAINLISTENINGMODE].Options
-      listLevelNames = dictOptions['LevelNames'].split('|')
-      strSelectedName = listLevelNames[int(int(Level)/10)]
-      if (self.blDebug ==  True):
-        Domoticz.Log('Main Listening Mode Selected: '+strSelectedName)
-      for selector in self.XMLRoot.find('device').find('controllist'):
-        if (selector.get('id')=='LMD '+strSelectedName):
-          strCode = selector.get('code')
-          self.objConnection.Send(Message=createISCPFrame(MESSAGE_LISTENINGMODE+strCode))
-
-    if (Unit==TUNERPRESETS):
-      #Tuner Preset Selector
-      dictOptions = Devices[TUNERPRESETS].Options
-      listLevelNames = dictOptions['LevelNames'].split('|')
-      strSelectedName = listLevelNames[int(int(Level)/10)]
-      if (self.blDebug ==  True):
-        Domoticz.Log('Tuner Preset Selected: '+strSelectedName)
-      intTunerPreset = int(strSelectedName[0:strSelectedName.find(' ')])
-      if (self.blDebug ==  True):
-        Domoticz.Log('Tuner Preset Number: '+str(intTunerPreset))
-      strTunerPreset = hex(intTunerPreset)[2:]
-      if len(strTunerPreset) == 1:
-        strTunerPreset = '0'+strTunerPreset
-      self.objConnection.Send(Message=createISCPFrame(MESSAGE_TUNERPRESET+strTunerPreset))
-
-    if (Unit==ZONE2POWER):
-      # Zone2 Power
-      if str(Command)=='On':
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_POWER2+'01'))
-      if str(Command)=='Off':
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_POWER2+'00'))
-
-    if (Unit==ZONE2VOLUME):
-      # Zone 2 Volume
-      if (Command=='Set Level'):
-        strVolume = hex(int((self.intZone2MaxVolume/100)*Level))[2:]
-        if len(strVolume) == 1:
-          strVolume = '0'+strVolume
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_VOLUME2+strVolume))
-      if (Command=='On'):
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_MUTE2+'00'))
-        #Unmute
-      if (Command=='Off'):
-        #Mute
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_MUTE2+'01'))
-
-    if (Unit==ZONE2SOURCE):
-      #Zone 2 input Selector
-      dictOptions = Devices[MAINSOURCE].Options
-      listLevelNames = dictOptions['LevelNames'].split('|')
-      strSelectedName = listLevelNames[int(int(Level)/10)]
-      Domoticz.Log('Zone 2 Source Selected: '+strSelectedName)
-      for selector in self.XMLRoot.find('device').find('selectorlist'):
-        if (selector.get('name')==strSelectedName):
-          strId = selector.get('id').upper()
-          self.objConnection.Send(Message=createISCPFrame(MESSAGE_SOURCE2+strId))
+    _log.debug('commands', "onCommand called for Unit %d: Parameter '%s', Level: %s", Unit, Command, Level)
+    tupleCommand = self.dictCommands.get(Unit)
+    if (tupleCommand != None):
+      tupleCommand[0](Unit, Command, Level, *tupleCommand[1])
 
-  def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
-    if (self.blDebug ==  True):
-      Domoticz.Log("Onkyo: Notification: " + Name + "," + Subject + "," + Text + "," + Status + "," + str(Priority) + "," + Sound + "," + ImageFile)
+  def commandPower(self, Unit, Command, Level, objZone):
+    if str(Command)=='On':
+      self.objSendQueue.send('!1'+objZone.strPower+'01')
+    if str(Command)=='Off':
+      self.objSendQueue.send('!1'+objZone.strPower+'00')
+
+  def commandVolume(self, Unit, Command, Level, objZone):
+    if (Command=='Set Level'):
+      strVolume = '%02x' % int((self.dictMaxVolume[Unit]/100)*Level)
+      self.objSendQueue.send('!1'+objZone.strVolume+strVolume)
+    if (Command=='On'):
+      #Unmute
+      self.objSendQueue.send('!1'+objZone.strMute+'00')
+    if (Command=='Off'):
+      #Mute
+      self.objSendQueue.send('!1'+objZone.strMute+'01')
+
+  def commandSource(self, Unit, Command, Level, objZone):
+    if (self.objModel == None):
+      self.commandRejected(Unit, Command, Level, 'the receiver information is not loaded yet')
+      return
+    strSelectedName = getSelectorName(Unit, Level)
+    _log.debug('commands', 'Source of %s selected: %s', objZone.strName, strSelectedName)
+    strId = self.objModel.dictSelectorId.get(strSelectedName)
+    if (strId == None):
+      self.commandRejected(Unit, Command, Level, 'unknown source ' + str(strSelectedName))
+      return
+    self.objSendQueue.send('!1'+objZone.strSource+strId)
+
+  def commandListeningMode(self, Unit, Command, Level):
+    if (self.objModel == None):
+      self.commandRejected(Unit, Command, Level, 'the receiver information is not loaded yet')
+      return
+    strSelectedName = getSelectorName(Unit, Level)
+    _log.debug('commands', 'Main Listening Mode Selected: %s', strSelectedName)
+    strCode = self.objModel.dictModeCode.get(strSelectedName)
+    if (strCode == None):
+      self.commandRejected(Unit, Command, Level, 'unknown listening mode ' + str(strSelectedName))
+      return
+    self.objSendQueue.send(MESSAGE_LISTENINGMODE+strCode)
+
+  def commandPreset(self, Unit, Command, Level):
+    if (self.objModel == None):
+      self.commandRejected(Unit, Command, Level, 'the receiver information is not loaded yet')
+      return
+    strSelectedName = getSelectorName(Unit, Level)
+    _log.debug('commands', 'Tuner Preset Selected: %s', strSelectedName)
+    strTunerPreset = self.objModel.dictPresetId.get(strSelectedName)
+    if (strTunerPreset == None):
+      self.commandRejected(Unit, Command, Level, 'unknown preset ' + str(strSelectedName))
+      return
+    self.objSendQueue.send(MESSAGE_TUNERPRESET+strTunerPreset)
+
+  def commandControl(self, Unit, Command, Level, objControl):
+    strSelectedName = getSelectorName(Unit, Level)
+    _log.debug('commands', '%s selected: %s', objControl.strControl, strSelectedName)
+    try:
+      intValue = int(strSelectedName)
+    except (TypeError, ValueError):
+      self.commandRejected(Unit, Command, Level, 'unknown ' + objControl.strControl.lower() + ' ' + str(strSelectedName))
+      return
+    self.objSendQueue.send('!1'+objControl.strCommand+objControl.strPrefix+controlValue(intValue))
+
+  def commandMacro(self, Unit, Command, Level):
+    strSelectedName = getSelectorName(Unit, Level)
+    if (self.objMacros.run(strSelectedName) == True):
+      self.objDeviceCache.update(Unit, 1, str(Level))
+    else:
+      self.commandRejected(Unit, Command, Level, 'unknown macro ' + str(strSelectedName))
+
+  def framesSent(self, listMessages):
+    # Called by the send queue with the messages of every write
+    self.objTracker.sent(listMessages)
+    if (self.objMacros.strAwait != None):
+      self.objMacros.sent(listMessages)
+
+  def commandResult(self, strMessage, strResult, fltSeconds, intAttempts):
+    # Outcome of a command, published on the state feed so automations know it took effect
+    if (strResult == 'ok'):
+      _log.debug('commands', 'Receiver %s reported %s after %d ms', self.strMAC, strMessage[2:], fltSeconds*1000)
+    elif (strResult == 'blocked'):
+      _log.info('Receiver %s did not accept %s', self.strMAC, strMessage[2:])
+    else:
+      _log.error('Receiver %s did not report %s, send %d times', self.strMAC, strMessage[2:], intAttempts)
+    self.setState(self.dictCommandZones.get(strMessage[2:5], 'receiver'), 'command', \
+                  {'message': strMessage[2:], 'result': strResult, 'ms': int(fltSeconds*1000), 'attempts': intAttempts}, True)
+
+  def commandRejected(self, Unit, Command, Level, strReason):
+    # A command from Domoticz that could not be send at all, reported like the outcome of one that was
+    _log.info('Receiver %s: command %s for Unit %d not send, %s', self.strMAC, Command, Unit, strReason)
+    self.setState(self.dictUnitZones.get(Unit - self.intUnitBase, 'receiver'), 'command', \
+                  {'message': None, 'result': 'blocked', 'ms': 0, 'attempts': 0, 'unit': Unit, 'command': Command, 'level': Level, \
+                   'reason': strReason}, True)
 
   def onDisconnect(self, Connection):
-    if (self.blDebug ==  True):
-      Domoticz.Log("onDisconnect called")
-    self.blDiscoverySocketCreated = False    # We reset the status to it's initial settings to start all over again.
-    self.blDiscoveryRequestSend = False
-    self.blDiscoverySucces = False
-    self.blConnectInitiated = False
-    self.blConnected = False
-    self.blCheckedDevices = False
-    self.blInitDone = False
+    _log.debug('connection', 'onDisconnect called for %s', self.strMAC)
+    self.connectionLost()
 
-  def onHeartbeat(self):
-    if (self.blDebug ==  True):
-      Domoticz.Log("onHeartbeat called")
-    if (self.blDiscoverySocketCreated==False): # If the UDP socket has not yet been created, do it now
-      self.createUDPSocket()
-    if (self.blDiscoveryRequestSend == True and self.blDiscoverySucces == False):
-      self.procesDiscoveryData()
-      if (self.blDiscoverySucces == False):
-        self.blDiscoveryRequestSend = False     # Resend Discovery frame
-    if (self.blDiscoveryRequestSend == False and self.blDiscoverySocketCreated == True): # If the discovery UDP packet has not been send, send it now
-      self.sendDiscoveryRequest()
-    if (self.blConnectInitiated == False and self.blDiscoverySucces == True):
+  def connectionLost(self):
+    # Reconnect to the address we know, right away at first and with a growing, jittered delay when
+    # that keeps failing. Only after RECONNECT_ATTEMPTS failures we start over with discovery.
+    if (self.intState < ReceiverState.CONNECTING):
+      return                                 # Already handled, a failed connect can also be reported twice
+    self.setState('receiver', 'connected', False)
+    self.objTracker.clear(self.objSendQueue.listQueue)
+    self.objSendQueue.clear()
+    self.objMacros.stop()
+    self.objParser = eISCPParser(self.streamFrame)   # Drop any partial frame
+    self.dictStateQueries = {}               # The states have to be synchronized again after a reconnect
+    if (self.intModelState == ModelState.REQUESTED):
+      self.intModelState = ModelState.UNKNOWN  # That request will not be answered, onConnect asks again
+    for strTask in ('keepalive', 'states', 'verify', 'xml'):
+      self.objScheduler.cancel(self.taskKey(strTask))
+    self.intReconnectAttempts += 1
+    if (self.intReconnectAttempts > RECONNECT_ATTEMPTS):
+      _log.info('Receiver %s can not be reached, looking for it again', self.strMAC)
+      self.intState = ReceiverState.LOST
+      self.intReconnectAttempts = 0
+      return
+    if (self.intReconnectAttempts == 1):
       self.connect()
-    if (self.blConnected==True and self.XMLProcessed==False):
-      self.workAround()
-    if (self.XMLProcessed==True and self.blCheckedDevices == False):
-      self.checkDevices()
-    if (self.blCheckedDevices == True and self.blCheckedStates == False):
+      return
+    fltDelay = min(RECONNECT_DELAY * pow(2, self.intReconnectAttempts-2), RECONNECT_MAX_DELAY)
+    self.intState = ReceiverState.WAITING
+    self.objScheduler.schedule(self.taskKey('connect'), fltDelay * random.uniform(0.5, 1.0), self.connect)
+
+  def keepAlive(self):
+    # Poll a receiver that has been quiet, and give up on the connection when it does not answer
+    fltSilence = time.time() - self.fltLastReceive
+    if (fltSilence >= 2*KEEPALIVE_INTERVAL):
+      _log.info('Receiver %s does not respond, reconnecting', self.strMAC)
+      self.objConnection.Disconnect()        # onDisconnect takes it from here
+      return
+    if (fltSilence >= KEEPALIVE_INTERVAL):
+      self.objSendQueue.send(MESSAGE_KEEPALIVE)
+    self.objScheduler.schedule(self.taskKey('keepalive'), KEEPALIVE_INTERVAL, self.keepAlive)
+
+  def verifyStates(self):
+    # Periodic full state query, so an update we missed does not stick
+    if (self.intState == ReceiverState.READY):
       self.getInitialStates()
-      self.blInitDone = True
-      Domoticz.Heartbeat(20)
-
-  def createUDPSocket(self):
-    if (self.blDebug ==  True):
-      Domoticz.Log("Creating UDP Socket for sending/receiving discovery data")
-    self.sockUDP = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    self.sockUDP.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    self.sockUDP.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    self.sockUDP.settimeout(0.1)
-    self.sockUDP.bind(('0.0.0.0', 60128))
-    self.blDiscoverySocketCreated = True
-    if (self.blDebug ==  True):
-      Domoticz.Log("UDP Socket created succesfully")
-
-  def sendDiscoveryRequest(self):
-    if (self.blDebug ==  True):
-      Domoticz.Log("Sending UDP discovery packet")
-    try:
-      self.sockUDP.sendto(createISCPFrame(MESSAGE_DISCOVER), ('<broadcast>', 60128))
-      self.blDiscoveryRequestSend = True
-      if (self.blDebug ==  True):
-        Domoticz.Log("UDP Discovery packet send succesfully")
-    except:
-      if (self.blDebug ==  True):
-        Domoticz.Log("UDP Discovery packet could not be send")
-
-  def procesDiscoveryData(self):
-    if (self.blDebug ==  True):
-      Domoticz.Log("Checking if discovery data has been received")
-    data = b''
-    blNothingReceived = False
-    while blNothingReceived != True: # Repeat this until we have no data left
-      try:
-        data, addr = self.sockUDP.recvfrom(BUFFER_SIZE)
-        strData = str(data,'utf-8')
-      except:
-        strData = ''
-        blNothingReceived = True
-      if strData.find('ECN', 0, len(strData)) != -1:
-        self.strIPAddress = (addr[0])
-        intStartOfNextSegment = strData.find('!', 0, len(strData))
-        strType = strData[intStartOfNextSegment+1:intStartOfNextSegment+2]
-        if strType == '1':
-          Domoticz.Log("Receiver found:")
-          self.strModel = strData[intStartOfNextSegment+5:strData.find('/', intStartOfNextSegment+5, len(strData))]
-          intStartOfNextSegment=strData.find('/', intStartOfNextSegment, len(strData))+1
-          self.strPort = strData[intStartOfNextSegment:strData.find('/', intStartOfNextSegment, len(strData))]
-          intStartOfNextSegment=strData.find('/', intStartOfNextSegment, len(strData))+1
-          self.strRegion = strData[intStartOfNextSegment:strData.find('/', intStartOfNextSegment, len(strData))]
-          intStartOfNextSegment=strData.find('/', intStartOfNextSegment, len(strData))+1
-          self.strMAC = strData[intStartOfNextSegment:intStartOfNextSegment+12]
-          Domoticz.Log("Type:       AV Receiver or Stereo Receiver")
-          Domoticz.Log("Type:       "+self.strModel)
-          if self.strRegion == 'DX':
-            Domoticz.Log("Region:     North American model")
-          if self.strRegion == 'JJ':
-            Domoticz.Log("Region:     Japanese model")
-          if self.strRegion == 'XX':
-            Domoticz.Log("Region:     European or Asian model")
-          Domoticz.Log("IP adress:  " + self.strIPAddress)
-          Domoticz.Log("eISCP port: " + self.strPort)
-          Domoticz.Log("MAC:        " + self.strMAC)
-          self.blDiscoverySucces = True
-          self.sockUDP.close() # We don't need this anymore
+
+  def found(self, strIPAddress, strModel, strPort, strRegion):
+    # Called when the receiver responded to a discovery broadcast
+    if (self.intState != ReceiverState.LOST):
+      return
+    _log.info("Receiver found:")
+    self.strIPAddress = strIPAddress
+    self.strModel = strModel
+    self.strPort = strPort
+    self.strRegion = strRegion
+    _log.info("Type:       AV Receiver or Stereo Receiver")
+    _log.info("Type:       %s", self.strModel)
+    if self.strRegion == 'DX':
+      _log.info("Region:     North American model")
+    if self.strRegion == 'JJ':
+      _log.info("Region:     Japanese model")
+    if self.strRegion == 'XX':
+      _log.info("Region:     European or Asian model")
+    _log.info("IP adress:  %s", self.strIPAddress)
+    _log.info("eISCP port: %s", self.strPort)
+    _log.info("MAC:        %s", self.strMAC)
+    _log.info('Units:      %d - %d', self.unit(1), self.unit(UNITS_PER_RECEIVER))
+    if (self.objModel == None):
+      self.loadCachedModel()
+    self.connect()
 
   def checkDevices(self):
-    Domoticz.Log("Checking if Devices exist")
-
-    for zone in self.XMLRoot.find('device').find('zonelist'):
-      if (int(zone.get('id'))==1) and (int(zone.get('value'))==1):
-        # Main zone
-        Domoticz.Log('Checking Main zone')
-        intMainMaxVolume = int(zone.get('volmax'))
-        if (MAINPOWER not in Devices):
-          Domoticz.Log("Receiver main power device does not exist, creating device")
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            ' '+zone.get('name')+" Power", Unit=MAINPOWER, TypeName="Switch",  \
-            Image=5).Create()
-        else:
-          Domoticz.Log("Receiver main power device exists")
-
-        if (MAINSOURCE not in Devices):
-          Domoticz.Log("Receiver input selector device does not exist, creating device")
-          strSelectorNames = 'Off'
-          strSelectorActions = ''
-          for selector in self.XMLRoot.find('device').find('selectorlist'):
-            strSelectorNames += '|' + selector.get('name')
-            strSelectorActions += '|'
-          dictOptions = {"LevelActions": strSelectorActions, \
-                     "LevelNames": strSelectorNames, \
-                     "LevelOffHidden": "true", \
-                     "SelectorStyle": "1"}
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            ' ' + zone.get('name') + " Source", Unit=MAINSOURCE, \
-            TypeName="Selector Switch", Switchtype=18, Image=5, \
-            Options = dictOptions).Create()
-        else:
-          Domoticz.Log("Receiver input selector device exists")
-
-        if (MAINLISTENINGMODE not in Devices):
-          Domoticz.Log("Receiver listening mode selector device does not exist, creating device")
-          strSelectorNames = 'Off'
-          strSelectorActions = ''
-          for control in self.XMLRoot.find('device').find('controllist'):
-            if (control.get('id')[0:3] == 'LMD'):
-              strSelectorNames += '|' + control.get('id')[4:]
-              strSelectorActions += '|'
-          dictOptions = {"LevelActions": strSelectorActions, \
-                     "LevelNames": strSelectorNames, \
-                     "LevelOffHidden": "true", \
-                     "SelectorStyle": "0"}
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            ' ' + zone.get('name') + " Mode", Unit=MAINLISTENINGMODE, \
-            TypeName="Selector Switch", Switchtype=18, Image=5, \
-            Options = dictOptions).Create()
-        else:
-          Domoticz.Log("Receiver listening mode selector device exists")
-
-        if (TUNERPRESETS not in Devices):
-          Domoticz.Log("Receiver Tuner preset selector device does not exist, creating device")
-          strSelectorNames = 'Off'
-          strSelectorActions = ''
-          for preset in self.XMLRoot.find('device').find('presetlist'):
-            if (preset.get('band') != '0'):
-              strSelectorNames += '|' + str(int('0x'+preset.get('id'),16))+' '+preset.get('name')
-              strSelectorActions += '|'
-          dictOptions = {"LevelActions": strSelectorActions, \
-                     "LevelNames": strSelectorNames, \
-                     "LevelOffHidden": "true", \
-                     "SelectorStyle": "1"}
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            " Tuner", Unit=TUNERPRESETS, \
-            TypeName="Selector Switch", Switchtype=18, Image=5, \
-            Options=dictOptions).Create()
-        else:
-          Domoticz.Log("Receiver Tuner preset selector device exists")
-
-        if (MAINVOLUME not in Devices):
-          Domoticz.Log("Receiver volume control device does not exist, creating device")
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            ' ' + zone.get('name') + " Volume", Unit=MAINVOLUME, Type=244, Subtype=73, \
-            Switchtype=7, Image=8).Create()
-        else:
-          Domoticz.Log("Receiver volume control device exists")
-
-      if (int(zone.get('id'))==2) and (int(zone.get('value'))==1):
-        # Zone 2
-        Domoticz.Log('Checking Zone 2')
-        intZone2MaxVolume = int(zone.get('volmax'))
-        if (ZONE2POWER not in Devices): 
-          Domoticz.Log("Receiver Zone 2 power device does not exist, creating device")
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            ' '+zone.get('name')+" Power", Unit=ZONE2POWER, TypeName="Switch",  \
-            Image=5).Create()
-        else:
-          Domoticz.Log("Receiver Zone 2 power device exists")
-
-        if (ZONE2SOURCE not in Devices):
-          Domoticz.Log("Receiver input selector Zone 2 device does not exist, creating device")
-          strSelectorNames = 'Off'
-          strSelectorActions = ''
-          for selector in self.XMLRoot.find('device').find('selectorlist'):
-            strSelectorNames += '|' + selector.get('name')
-            strSelectorActions += '|'
-          dictOptions = {"LevelActions": strSelectorActions, \
-                     "LevelNames": strSelectorNames, \
-                     "LevelOffHidden": "true", \
-                     "SelectorStyle": "1"}
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            ' ' + zone.get('name') + " Source", Unit=ZONE2SOURCE, \
-            TypeName="Selector Switch", Switchtype=18, Image=5, \
-            Options = dictOptions).Create()
-        else:
-          Domoticz.Log("Receiver input selector Zone 2 device exists")
-
-        if (ZONE2VOLUME not in Devices):
-          Domoticz.Log("Receiver Zone 2 volume control device does not exist, creating device")
-          Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
-            ' ' + zone.get('name') + " Volume", Unit=ZONE2VOLUME, Type=244, Subtype=73, \
-            Switchtype=7, Image=8).Create()
-        else:
-          Domoticz.Log("Receiver volume control device exists")
-
-    self.blCheckedDevices = True
+    _log.info("Checking if Devices exist")
+    listSources = [strName for strId, strName in self.objModel.listSelectors]
+    for objZone in ZONES:
+      zone = self.objModel.zone(objZone.intId)
+      if (zone == None):
+        continue
+      _log.debug('devices', 'Checking zone %s', zone.strName)
+      if (zone.intVolMax > 0):
+        self.dictMaxVolume[self.unit(objZone.intVolumeUnit)] = zone.intVolMax
+      self.createDevice(objZone.intPowerUnit, zone.strName + " Power", TypeName="Switch", Image=5)
+      self.createDevice(objZone.intSourceUnit, zone.strName + " Source", TypeName="Selector Switch", Switchtype=18, Image=5, \
+                        Options=selectorOptions(listSources, "1"))
+      self.createDevice(objZone.intVolumeUnit, zone.strName + " Volume", Type=244, Subtype=73, Switchtype=7, Image=8)
+      if (objZone.intId == 1):
+        self.createDevice(MAINLISTENINGMODE, zone.strName + " Mode", TypeName="Selector Switch", Switchtype=18, Image=5, \
+                          Options=selectorOptions([strName for strCode, strName in self.objModel.listModes], "0"))
+        self.createDevice(TUNERPRESETS, "Tuner", TypeName="Selector Switch", Switchtype=18, Image=5, \
+                          Options=selectorOptions([presetLevelName(strId, strName) for strId, strBand, strName in self.objModel.listPresets \
+                                                   if (strBand != '0')], "1"))
+      for objControl in objZone.listControls:
+        tupleRange = self.objModel.dictControls.get((objControl.strControl, objZone.intId))
+        if (tupleRange != None):
+          intMin, intMax, intStep = tupleRange
+          self.createDevice(objControl.intUnit, zone.strName + ' ' + objControl.strControl, TypeName="Selector Switch", \
+                            Switchtype=18, Image=8, \
+                            Options=selectorOptions([controlLevelName(intValue) for intValue in range(intMin, intMax+1, intStep)], "1"))
+
+    if (len(self.listMacroNames) > 0):
+      self.createDevice(MACROS, "Macros", TypeName="Selector Switch", Switchtype=18, Image=5, \
+                        Options=selectorOptions(self.listMacroNames, "1"))
+
+    for intUnit in range(self.unit(1), self.unit(UNITS_PER_RECEIVER)+1):
+      invalidateSelectorIndex(intUnit)       # Device options may have changed
+    self.objDeviceCache.forget()
+    self.prebuildFrames()
+
+  def createDevice(self, intOffset, strName, **kwargs):
+    # Create a device of this receiver, named after the model, unless it exists. Returns True if it was created.
+    # The levels of an existing selector are updated when they changed, like after a firmware update
+    # that added an input, or when the macros changed.
+    if (self.unit(intOffset) in Devices):
+      objDevice = Devices[self.unit(intOffset)]
+      dictOptions = kwargs.get('Options')
+      if (dictOptions != None) and (objDevice.Options.get("LevelNames") != dictOptions.get("LevelNames")):
+        _log.info('Receiver %s device levels changed, updating device', strName)
+        objDevice.Update(nValue=objDevice.nValue, sValue=objDevice.sValue, Options=dictOptions)
+      else:
+        _log.debug('devices', 'Receiver %s device exists', strName)
+      return False
+    _log.info('Receiver %s device does not exist, creating device', strName)
+    Domoticz.Device(Name=self.objModel.strModel + ' ' + strName, Unit=self.unit(intOffset), **kwargs).Create()
+    return True
+
+  def prebuildFrames(self):
+    # Build the frames for every source, listening mode, preset and volume level of this model
+    listMessages = []
+    for objZone in ZONES:
+      if (self.objModel.zone(objZone.intId) != None):
+        listMessages += ['!1' + objZone.strSource + strId for strId, strName in self.objModel.listSelectors]
+        listMessages += ['!1' + objZone.strVolume + '%02x' % intLevel \
+                         for intLevel in range(0, self.dictMaxVolume[self.unit(objZone.intVolumeUnit)]+1)]
+    for strCode, strName in self.objModel.listModes:
+      listMessages.append(MESSAGE_LISTENINGMODE+strCode)
+    for strId, strBand, strName in self.objModel.listPresets:
+      listMessages.append(MESSAGE_TUNERPRESET+strId)
+    prebuildISCPFrames(listMessages)
 
   def getInitialStates(self):
-    for zone in self.XMLRoot.find('device').find('zonelist'):
-      if (int(zone.get('id'))==1) and (int(zone.get('value'))==1):
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_POWER+'QSTN'), Delay=1)
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_VOLUME+'QSTN'), Delay=2)
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_SOURCE+'QSTN'), Delay=3)
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_TUNERPRESET+'QSTN'), Delay=4)
-      if (int(zone.get('id'))==2) and (int(zone.get('value'))==1):
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_POWER2+'QSTN'), Delay=5)
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_VOLUME2+'QSTN'), Delay=6)
-        self.objConnection.Send(Message=createISCPFrame(MESSAGE_SOURCE2+'QSTN'), Delay=7)
-    self.blCheckedStates = True
-    
+    # Ask for the state of every zone in a single write, the answers are tracked in dictStateQueries
+    self.dictStateQueries = {}
+    for objZone in ZONES:
+      if (self.objModel.zone(objZone.intId) == None):
+        continue
+      listCommands = [objZone.strPower, objZone.strMute, objZone.strVolume, objZone.strSource]
+      if (objZone.intId == 1):
+        listCommands += [MESSAGE_LISTENINGMODE[2:5], MESSAGE_TUNERPRESET[2:5]]
+      for objControl in objZone.listControls:
+        if ((objControl.strControl, objZone.intId) in self.objModel.dictControls):
+          listCommands.append(objControl.strCommand)
+      for strCommand in listCommands:
+        self.dictStateQueries[strCommand] = '!1' + strCommand + 'QSTN'
+    self.intStateQueryRetries = 0
+    self.intState = ReceiverState.SYNCING
+    self.objScheduler.cancel(self.taskKey('verify'))
+    self.sendStateQueries()
+
+  def sendStateQueries(self):
+    self.objConnection.Send(Message=b''.join([createISCPFrame(strMessage) for strMessage in self.dictStateQueries.values()]))
+    self.objMetrics.sent(self.objConnection.Name, self.dictStateQueries.values())
+    self.fltStateQueryTime = time.time()
+    self.objScheduler.schedule(self.taskKey('states'), STATE_QUERY_TIMEOUT, self.checkStateQueries)
+
+  def checkStateQueries(self):
+    # Repeat the state queries that have not been answered in time
+    if (len(self.dictStateQueries) == 0):
+      self.statesDone()
+      return
+    if (self.intStateQueryRetries >= STATE_QUERY_RETRIES):
+      _log.info('No answer from receiver %s for: %s', self.strMAC, ', '.join(self.dictStateQueries))
+      self.dictStateQueries = {}
+      self.statesDone()
+      return
+    self.intStateQueryRetries += 1
+    if (_log.isDebug('connection') == True):
+      _log.debug('connection', 'Repeating state queries: %s', ', '.join(self.dictStateQueries))
+    self.sendStateQueries()
+
+  def answerStateQuery(self, strCommand):
+    del self.dictStateQueries[strCommand]
+    if (len(self.dictStateQueries) == 0):
+      _log.debug('connection', 'State of all zones received in %d ms', (time.time()-self.fltStateQueryTime)*1000)
+      self.statesDone()
+
+  def statesDone(self):
+    self.objScheduler.cancel(self.taskKey('states'))
+    if (self.intState == ReceiverState.SYNCING):
+      self.intState = ReceiverState.READY
+    self.objScheduler.schedule(self.taskKey('verify'), STATE_VERIFY_INTERVAL, self.verifyStates)
+
+  def getConnectionName(self):
+    return "Onkyo " + self.strMAC
 
   def connect(self):
-    if (self.blDebug ==  True):
-      Domoticz.Log("Connecting to Receiver")
-    self.objConnection = Domoticz.Connection(Name="Onkyo Connection", Transport="TCP/IP", Protocol="NONE", Address=self.strIPAddress, Port=self.strPort)
+    _log.debug('connection', 'Connecting to receiver %s at %s:%s', self.strMAC, self.strIPAddress, self.strPort)
+    if (self.objConnection == None) or (self.objConnection.Address != self.strIPAddress) or (self.objConnection.Port != self.strPort):
+      self.objConnection = Domoticz.Connection(Name=self.getConnectionName(), Transport="TCP/IP", Protocol="NONE", Address=self.strIPAddress, Port=self.strPort)
+    self.objScheduler.cancel(self.taskKey('connect'))
     self.objConnection.Connect()
+    self.objSendQueue.objConnection = self.objConnection
 #    Domoticz.Transport(Transport="TCP/IP", Address=self.strIPAddress, Port=self.strPort)
 #    Domoticz.Protocol("None")
 #    Domoticz.Connect()
-    self.blConnectInitiated =  True
+    self.intState = ReceiverState.CONNECTING
 
-  def workAround(self):
-    Domoticz.Log("Loading XML from file")
+  def requestReceiverInformation(self):
+    # Ask for the XML of the receiver, and again every XML_RETRY_INTERVAL until it validated objModel.
+    # A cached model is used in the meantime, so for that the retries only keep the validation going.
+    if (self.intModelState >= ModelState.PARSING):
+      return                                 # The worker is parsing it, or we are done
     self.objConnection.Send(Message=createISCPFrame(MESSAGE_RECEIVER_INFORMATION))
-    try: 
-      f = open('XMLDataFile.xml', 'r')            # We do exactly the same here as in the processeISCPFrame function
-      strXML = f.read()                           # However, now it does not cause Domoticz to lock up
-      f.close()                                   # Only difference is that this function is called from onHeartbeat
-      self.XMLRoot = XMLTree.fromstring(strXML)   # And the other from onMessage
-      self.XMLProcessed=True                      # If anyone knows what causes this behaviour, drop me a line
-    except:
-      Domoticz.Log("XML file does not yet exist")
-
-  def checkInputBuffer(self):
-    intStartOfFrame = self.bInputBuffer.find(b'ISCP')
-    if (intStartOfFrame > -1): 
-      if (intStartOfFrame > 0):
-        if (self.blDebug ==  True):
-          Domoticz.Log('We have garbage in the input buffer, getting rid of: '+str(intStartOfFrame)+' bytes.')
-        self.bInputBuffer = self.bInputBuffer[intStartOfFrame:]    # Get rid of possible left overs in front of the first complete frame
-      if (self.blDebug ==  True):
-        Domoticz.Log('Found ISCP frame')
-      intHeaderSize = self.bInputBuffer[7] + pow(2,8)*self.bInputBuffer[6] +  pow(2,16) * self.bInputBuffer[5] + pow(2,32)*self.bInputBuffer[4]
-      if (self.blDebug ==  True):
-        Domoticz.Log('HeaderSize: '+ str(intHeaderSize))
-      intDataSize = self.bInputBuffer[11] + pow(2,8)*self.bInputBuffer[10] +  pow(2,16) * self.bInputBuffer[9] + pow(2,32)*self.bInputBuffer[8]
-      if (self.blDebug ==  True):
-        Domoticz.Log('DataSize: '+ str(intDataSize))
-        Domoticz.Log('Have ' + str(len(self.bInputBuffer)) + ' bytes in inputbuffer') 
-      if (len(self.bInputBuffer) >= intHeaderSize + intDataSize): 
-        return True
+    self.objMetrics.sent(self.objConnection.Name, (MESSAGE_RECEIVER_INFORMATION,))
+    self.intModelState = ModelState.REQUESTED
+    self.objScheduler.schedule(self.taskKey('xml'), XML_RETRY_INTERVAL, self.requestReceiverInformation)   # Ask again if it does not come
+
+  def receiverInformation(self, objModel, strError, fltSeconds):
+    # The worker is done with the XML of the receiver, objModel is None if it could not be parsed
+    if (objModel == None):
+      self.intModelState = ModelState.UNKNOWN
+      _log.error("Receiver information could not be parsed: %s", strError)
+      if (self.connected() == True):
+        self.objScheduler.schedule(self.taskKey('xml'), XML_RETRY_INTERVAL, self.requestReceiverInformation)
+      return
+    _log.debug('devices', 'Receiver information parsed in %.1f ms', fltSeconds*1000)
+    self.intModelState = ModelState.VALIDATED
+    if (self.objModel != None):
+      if (objModel.snapshot() == self.objModel.snapshot()):
+        _log.info("Cached receiver information is up to date")
+        return
+      _log.info("Receiver information has changed, updating cache")
+    self.objModel = objModel
+    self.saveCachedModel()
+    if (_log.isDebug('devices') == True):
+      self.logModel()
+    self.checkDevices()
+    if (self.connected() == True):
+      self.getInitialStates()
+
+  def getCacheFile(self):
+    return os.path.join(Parameters["HomeFolder"], 'Onkyo-' + self.strMAC + '.cache')
+
+  def loadCachedModel(self):
+    # Use the receiver information from the cache, if we have it for this receiver. It is still
+    # validated against the XML of the receiver once we are connected.
+    try:
+      with open(self.getCacheFile(), 'rb') as f:
+        intVersion, strMAC, strModel, tupleSnapshot = pickle.load(f)
+      if (intVersion != CACHE_VERSION) or (strMAC != self.strMAC) or (strModel != self.strModel):
+        return
+      self.objModel = ReceiverModel.fromSnapshot(tupleSnapshot)
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError):
+      return
+    _log.info('Using cached receiver information, firmware %s', self.objModel.strFirmware)
+    self.checkDevices()
+
+  def saveCachedModel(self):
+    try:
+      with open(self.getCacheFile(), 'wb') as f:
+        pickle.dump((CACHE_VERSION, self.strMAC, self.strModel, self.objModel.snapshot()), f, pickle.HIGHEST_PROTOCOL)
+    except IOError:
+      _log.error('Could not write the receiver information cache: %s', self.getCacheFile())
+
+  def processeISCPFrame(self, strCommand, strMessage):
+    if (strCommand == self.objSendQueue.strEcho):
+      self.objSendQueue.echoed()
+    if (strCommand in self.dictStateQueries):
+      self.answerStateQuery(strCommand)
+    if (self.objMacros.strAwait != None):
+      self.objMacros.received(strCommand, strMessage)
+    if (strCommand in self.objTracker.dictInFlight):
+      self.objTracker.received(strCommand, strMessage)
+    tupleHandler = self.dictHandlers.get(strCommand)
+    if (tupleHandler != None):
+      tupleHandler[0](strMessage, *tupleHandler[1])
+    else:
+      _log.debug('dispatch', 'No handler for eISCP command: %s', strCommand)
+
+  def handlePower(self, strMessage, intUnit, strZone):
+    if strMessage=='01':
+      #Power On
+      self.objDeviceCache.update(intUnit, 1, "On")
+      self.setState(strZone, 'power', True)
+    if strMessage=='00':
+      # Power Off
+      self.objDeviceCache.update(intUnit, 0, "Off")
+      self.setState(strZone, 'power', False)
+
+  def handleMute(self, strMessage, intUnit, strZone):
+    if strMessage=='01':
+      #Mute
+      self.objDeviceCache.update(intUnit, 0, "Off")
+      self.setState(strZone, 'mute', True)
+    if strMessage=='00':
+      #Unmute
+      self.objDeviceCache.update(intUnit, 1, "On")
+      self.setState(strZone, 'mute', False)
+
+  def handleVolume(self, strMessage, intUnit, strZone):
+    if strMessage == 'N/A':
+      return
+    intVolume = int(int('0x'+strMessage, 16)*(100/self.dictMaxVolume[intUnit]))
+    _log.debug('dispatch', 'Volume: %d', intVolume)
+    self.objDeviceCache.update(intUnit,2,str(intVolume))
+    self.setState(strZone, 'volume', intVolume)
+
+  def handleSource(self, strMessage, intUnit, strZone):
+    _log.debug('dispatch', 'Source: %s', strMessage)
+    if (self.objModel == None):
+      return
+    strName = self.objModel.dictSelectorName.get(strMessage.upper())
+    if (strName != None):
+      _log.debug('dispatch', 'Current Source: %s', strName)
+      setSelectorByName(intUnit, strName, self.objDeviceCache)
+    self.setState(strZone, 'source', strName or strMessage.upper())
+
+  def handlePreset(self, strMessage, intUnit, strZone):
+    _log.debug('dispatch', 'Preset: %s', strMessage)
+    if (self.objModel == None):
+      return
+    strPresetName = self.objModel.dictPresetName.get(strMessage.upper())
+    if (strPresetName != None):
+      setSelectorByName(intUnit, strPresetName, self.objDeviceCache)
+    self.setState(strZone, 'preset', strPresetName or strMessage.upper())
+
+  def handleListeningMode(self, strMessage, intUnit, strZone):
+    _log.debug('dispatch', 'Listening mode: %s', strMessage)
+    if (strMessage != 'N/A') and (self.objModel != None):
+      strListeningModeName = self.objModel.dictModeName.get(strMessage.upper())
+      self.setState(strZone, 'mode', strListeningModeName or strMessage.upper())
+      if (strListeningModeName != None):
+        setSelectorByName(intUnit, strListeningModeName, self.objDeviceCache)
       else:
-        return False    # We do not have a complete frame yet
-    return False
+        if (setSelectorByCode(intUnit, strMessage.upper(), self.objDeviceCache) == False):
+          addListeningMode(intUnit, strMessage.upper())
+          setSelectorByCode(intUnit, strMessage.upper(), self.objDeviceCache)
 
-  def processeISCPFrame(self):
-    if (self.bInputBuffer[0:4] == b'ISCP'):
-      if (self.blDebug ==  True):
-        Domoticz.Log('Found ISCP frame')
-      intHeaderSize = self.bInputBuffer[7] + pow(2,8)*self.bInputBuffer[6] +  pow(2,16) * self.bInputBuffer[5] + pow(2,32)*self.bInputBuffer[4]
-      if (self.blDebug ==  True):
-        Domoticz.Log('HeaderSize: '+ str(intHeaderSize))
-      intDataSize = self.bInputBuffer[11] + pow(2,8)*self.bInputBuffer[10] +  pow(2,16) * self.bInputBuffer[9] + pow(2,32)*self.bInputBuffer[8]
-      if (self.blDebug ==  True):
-        Domoticz.Log('DataSize: '+ str(intDataSize))
-      intVersion = int(self.bInputBuffer[12])
-      if (self.blDebug ==  True):
-        Domoticz.Log('Version: ' + str(intVersion))
-        Domoticz.Log('Reserved: [' + hex(self.bInputBuffer[13])+']['+ hex(self.bInputBuffer[14])+']['+ hex(self.bInputBuffer[15])+']')
-      streISCPData = self.bInputBuffer[16:21].decode(encoding="ascii", errors="ignore")
-      if (self.blDebug ==  True):
-        Domoticz.Log('eISCP Data : ' + streISCPData)
-      streISCPMessage = self.bInputBuffer[21: self.bInputBuffer[21:].find(EOF)-2].decode(encoding="ascii", errors="ignore")
-      if (self.blDebug ==  True):
-        Domoticz.Log('eISCP Message: ' + streISCPMessage)
-      self.bInputBuffer = self.bInputBuffer[16+intDataSize:]  # Remove this frame from the InputBuffer
-      if (streISCPData=='!1PWR'):
-        #Main Zone Power
-        if streISCPMessage=='01':
-          #Power On
-          UpdateDevice(MAINPOWER, 1, "On")
-        if streISCPMessage=='00':
-          # Power Off
-          UpdateDevice(MAINPOWER, 0, "Off")
-      if (streISCPData=='!1AMT'):
-        if streISCPMessage=='01':
-          #Mute
-          UpdateDevice(MAINVOLUME, 0, "Off")
-        if streISCPMessage=='00':
-          #Unmute
-          UpdateDevice(MAINVOLUME, 1, "On")
-      if (streISCPData=='!1MVL'):
-        if streISCPMessage == 'N/A':
-          intVolume = NA
-        else:
-          intVolume = int(int('0x'+streISCPMessage, 16)*(100/self.intMainMaxVolume))
-        if (intVolume != NA):
-          Domoticz.Log('Volume: '+str(intVolume))
-          UpdateDevice(MAINVOLUME,2,str(intVolume))
-      if (streISCPData=='!1SLI'):
-        if (self.blDebug ==  True):
-          Domoticz.Log('Source: '+streISCPMessage)
-        for selector in self.XMLRoot.find('device').find('selectorlist'):
-          if (selector.get('id').upper() == streISCPMessage.upper()):
-            Domoticz.Log('Current Source: '+selector.get('name'))
-            setSelectorByName(MAINSOURCE, selector.get('name'))
-      if (streISCPData=='!1ZPW'):
-        #Main Zone Power
-        if streISCPMessage=='01':
-          #Power On
-          UpdateDevice(ZONE2POWER, 1, "On")
-        if streISCPMessage=='00':
-          # Power Off
-          UpdateDevice(ZONE2POWER, 0, "Off")
-      if (streISCPData=='!1ZMT'):
-        if streISCPMessage=='01':
-          #Mute
-          UpdateDevice(ZONE2VOLUME, 0, "Off")
-        if streISCPMessage=='00':
-          #Unmute
-          UpdateDevice(ZONE2VOLUME, 1, "On")
-      if (streISCPData=='!1ZVL'):
-        if streISCPMessage == 'N/A':
-          intVolume = NA
-        else:
-          intVolume = int(int('0x'+streISCPMessage, 16)*(100/self.intZone2MaxVolume))
-        if (intVolume != NA):
-          Domoticz.Log('Zone2 volume: '+str(intVolume))
-          UpdateDevice(ZONE2VOLUME,2,str(intVolume))
-      if (streISCPData=='!1SLZ'):
-        if (self.blDebug ==  True):
-          Domoticz.Log('Zone 2 source: '+streISCPMessage)
-        for selector in self.XMLRoot.find('device').find('selectorlist'):
-          if (selector.get('id').upper() == streISCPMessage.upper()):
-            Domoticz.Log('Zone 2 Current Source: '+selector.get('name'))
-            setSelectorByName(ZONE2SOURCE, selector.get('name'))
-      if (streISCPData=='!1PRS'):
-        if (self.blDebug ==  True):
-          Domoticz.Log('Preset: '+streISCPMessage)
-        for preset in self.XMLRoot.find('device').find('presetlist'):
-          if (preset.get('id').upper() == streISCPMessage.upper()):
-            strPresetName = str(int('0x'+preset.get('id'),16))+' '+preset.get('name')
-            setSelectorByName(TUNERPRESETS, strPresetName)
-
-      if (streISCPData=='!1LMD'):
-        if (self.blDebug ==  True):
-          Domoticz.Log('Listening mode: '+streISCPMessage)
-        if (streISCPMessage != 'N/A'):
-          blLMDFound = False
-          for control in self.XMLRoot.find('device').find('controllist'):
-            if (control.get('id')[0:3] == 'LMD'):
-              Domoticz.Log('EISCP message: '+ streISCPMessage)
-              Domoticz.Log('XML code: '+ control.get('code'))
-              if (control.get('code').upper() == streISCPMessage.upper()):
-               strListeningModeName = control.get('id')[4:]
-               setSelectorByName(MAINLISTENINGMODE, strListeningModeName)
-               blLMDFound = True
-          if (blLMDFound == False):
-            if (setSelectorByCode(MAINLISTENINGMODE, streISCPMessage.upper()) == False):
-              addListeningMode(streISCPMessage.upper())
-              setSelectorByCode(MAINLISTENINGMODE, streISCPMessage.upper())
-  
-      if (streISCPData=='!1NRI'):
-        # We should now have the XML
-        Domoticz.Log('Received XML')
-        strXML = streISCPMessage[streISCPMessage.find('<'):streISCPMessage.rfind('>')+1]
-        # self.XMLRoot = XMLTree.fromstring(strXML) # <-- This statement causes Domoticz to lock up, don´t know why
-        f = open('XMLDataFile.xml', 'w')            # So instead I write it to a file
-        f.write(strXML)
-        f.close()
-        #f = open('XMLDataFile.xml', 'r')           # Even if I read it from the file, it causes a lock up here.
-        #strXML2 = f.read()                         # However I do the same in the workaround, and then it does not lock up
-        #f.close()                                  # If anyone knows what causes this behaviour, drop me a line
-        #self.XMLRoot = XMLTree.fromstring(strXML2) # <-- This statement causes Domoticz to lock up
-        #self.ProcessXML()
+  def streamFrame(self, strCommand, bChunk, blFirst, blLast):
+    # A part of the XML of the receiver (NRI), the worker parses it while it arrives
+    self.objModelWorker.feed(self.strMAC, bChunk, blFirst, blLast)
+
+  def handleControl(self, strMessage, dictPrefixes, strZone):
+    # Tone or level status, 'B+2T-1' for a command with several controls, '-A' for one without
+    _log.debug('dispatch', 'Control: %s', strMessage)
+    for strPrefix, strValue in CONTROL_VALUE.findall(strMessage):
+      objControl = dictPrefixes.get(strPrefix)
+      if (objControl != None):
+        intValue = int(strValue, 16)
+        setSelectorByName(self.unit(objControl.intUnit), controlLevelName(intValue), self.objDeviceCache)
+        self.setState(strZone, objControl.strKey, intValue)
+
+  def handleMetadata(self, strMessage, strKey, intOffset, strName):
+    # Title, artist or album of what a network or USB source is playing
+    self.setState('net', strKey, strMessage)
+    self.updateText(intOffset, strName, strMessage)
+
+  def handlePlayTime(self, strMessage):
+    # 'mm:ss/mm:ss' every second while playing, the device cache only writes it every METADATA_TIME_INTERVAL
+    self.setState('net', 'time', strMessage)
+    self.updateText(METADATA_TIME, 'Time', strMessage)
+
+  def handleCoverArt(self, strMessage):
+    strArt = self.objCoverArt.feed(strMessage)
+    if (strArt != None):
+      self.setState('net', 'art', strArt)
+
+  def updateText(self, intOffset, strName, strText):
+    # The now playing devices are only created once the receiver sends something to show
+    if (self.unit(intOffset) not in Devices):
+      if (self.objModel == None) or (strText == ''):
+        return
+      self.createDevice(intOffset, strName, TypeName="Text", Image=8)
+    self.objDeviceCache.update(self.unit(intOffset), 0, strText)
+
+  def handleReceiverInformation(self, strMessage):
+    # We have the complete XML, the worker builds the model and receiverInformation gets it
+    _log.info('Received XML')
+    self.intModelState = ModelState.PARSING
+    self.objScheduler.cancel(self.taskKey('xml'))
+
+  def logModel(self):
+    _log.debug('devices', 'model          : %s', self.objModel.strModel)
+    _log.debug('devices', 'firmwareversion: %s', self.objModel.strFirmware)
+    for zone in self.objModel.listZones:
+      _log.debug('devices', 'zone id: %d, enabled: %s, name: %s, volmax: %d', zone.intId, zone.blEnabled, zone.strName, zone.intVolMax)
+    for strId, strName in self.objModel.listSelectors:
+      _log.debug('devices', 'selector id: %s, name: %s', strId, strName)
+    for strId, strBand, strName in self.objModel.listPresets:
+      _log.debug('devices', 'preset id: %s, band: %s, name: %s', strId, strBand, strName)
+    for strCode, strName in self.objModel.listModes:
+      _log.debug('devices', 'control id: %s, code: %s', strName, strCode)
+
+class Onkyo:
+  enabled = False
+
+  def __init__(self):
+    self.blDebug = False                     # Is debugging turned on
+    self.fltCommandInterval = COMMAND_INTERVAL/1000   # Minimum time between two frames send to a receiver
+    self.listMacros = []                     # (name, steps) of the macros of Mode2, the same for every receiver
+    self.objScheduler = TaskScheduler()      # Timer wheel shared by discovery and all receivers
+    self.objMetrics = Metrics()              # Hot path counters and timings of all receivers
+    self.objFeed = StateFeed()               # Pushes the state of the receivers to local clients
+    self.objModelWorker = ModelWorker()      # Parses the XML of the receivers on its own thread
+    self.blMetricDevices = False             # Are the metrics also shown as devices
+    self.objDiscovery = DiscoveryEngine(self.receiverFound, self.objScheduler)   # Finds the receivers on the network
+    self.dictReceivers = {}                  # MAC -> Receiver
+    self.dictConnections = {}                # Connection name -> Receiver
+    self.dictUnitBases = {}                  # MAC -> unit base of the receiver, stored in the home folder
+    self.intHeartbeat = 0                    # Current heartbeat interval
+    return
+
+  def onStart(self):
+    if Parameters["Mode6"] == "Debug":
+      self.blDebug = True
+      Domoticz.Debugging(1)
+    try:
+      self.fltCommandInterval = max(int(Parameters["Mode1"]), 0)/1000
+    except (KeyError, ValueError):
+      self.fltCommandInterval = COMMAND_INTERVAL/1000
+    _log.configure(self.blDebug, Parameters.get("Mode5", ""))
+    self.objMetrics.blEnabled = Parameters.get("Mode4", "Off") in ("Log", "Devices")
+    self.blMetricDevices = Parameters.get("Mode4", "Off") == "Devices"
+    
+    _log.debug('plugin', 'onStart called')
+    self.loadUnitBases()
+    self.loadMacros(Parameters.get("Mode2", ""))
+    if (self.blMetricDevices == True):
+      self.checkMetricDevices()
+    if (self.objMetrics.blEnabled == True):
+      self.objMetrics.reset()
+      self.objScheduler.schedule('metrics', METRICS_INTERVAL, self.reportMetrics)
+    if (Parameters.get("Mode3", "").strip() != ""):
+      try:
+        self.objFeed.start(int(Parameters["Mode3"]))
+      except ValueError:
+        _log.error('State feed port is not a number: %s', Parameters["Mode3"])
+    self.objDiscovery.start()
+    self.updateHeartbeat()
+
+  def onStop(self):
+    _log.debug('plugin', 'onStop called')
+    self.objDiscovery.stop()
+    self.objFeed.stop()
+    self.objModelWorker.stop()
+
+  def onConnect(self, Connection, Status, Description):
+    if (self.objFeed.isConnection(Connection) == True):
+      self.objFeed.onConnect(Connection, Status, Description)
+      return
+    objReceiver = self.dictConnections.get(Connection.Name)
+    if (objReceiver != None):
+      objReceiver.onConnect(Connection, Status, Description)
+      if (objReceiver.intState == ReceiverState.LOST):
+        self.objDiscovery.start()
+    self.updateHeartbeat()
+
+  def onMessage(self, Connection, Data, Status, Extra):
+    _log.debug('framing', 'onMessage called for %s, %d bytes of data', Connection.Name, len(Data))
+    if (self.objDiscovery.isConnection(Connection) == True):
+      self.objDiscovery.onMessage(Connection, Data)
+      return
+    if (self.objFeed.isConnection(Connection) == True):
+      self.objFeed.onMessage(Connection, Data)
+      return
+    objReceiver = self.dictConnections.get(Connection.Name)
+    if (objReceiver != None):
+      objReceiver.onMessage(Connection, Data)
+      self.updateHeartbeat()
+
+  def onCommand(self, Unit, Command, Level, Hue):
+    objReceiver = self.getUnitReceiver(Unit)
+    if (objReceiver == None):
+      _log.info('Onkyo: no receiver for Unit %d', Unit)
+      return
+    if (objReceiver.connected() == False):
+      objReceiver.commandRejected(Unit, Command, Level, 'the receiver is not connected')
+      return
+    if (self.objMetrics.blEnabled == True):
+      fltStart = time.perf_counter()
+      objReceiver.onCommand(Unit, Command, Level, Hue)
+      self.objMetrics.observe('command', time.perf_counter() - fltStart)
     else:
-      if (self.blDebug ==  True):
-        Domoticz.Log('NON eISCP data found: ' + data)
-
-  def ProcessXML(self):
-    Domoticz.Log('Response status: ' + self.XMLRoot.get('status'))
-    Domoticz.Log('id             : ' + (self.XMLRoot.find('device').attrib).get('id'))
-    Domoticz.Log('brand          : ' + (self.XMLRoot.find('device')).find('brand').text)
-    Domoticz.Log('category       : ' + (self.XMLRoot.find('device')).find('category').text)
-    Domoticz.Log('brand          : ' + (self.XMLRoot.find('device')).find('brand').text)
-    Domoticz.Log('year           : ' + (self.XMLRoot.find('device')).find('year').text)
-    Domoticz.Log('model          : ' + (self.XMLRoot.find('device')).find('model').text)
-    Domoticz.Log('destination    : ' + (self.XMLRoot.find('device')).find('destination').text)
-    Domoticz.Log('modeliconurl   : ' + (self.XMLRoot.find('device')).find('modeliconurl').text)
-    Domoticz.Log('friendlyname   : ' + (self.XMLRoot.find('device')).find('friendlyname').text)
-    Domoticz.Log('firmwareversion: ' + (self.XMLRoot.find('device')).find('firmwareversion').text)
-    Domoticz.Log('zonelist: ' + (self.XMLRoot.find('device').find('zonelist')).get('count'))
-    for zone in self.XMLRoot.find('device').find('zonelist'):
-      Domoticz.Log('zone id: ' + zone.get('id') + ', value: ' + zone.get('value') + ', name: ' + zone.get('name') + ', volmax: ' + zone.get('volmax'))
-    Domoticz.Log('selectorlist: ' + (self.XMLRoot.find('device').find('selectorlist')).get('count'))
-    for selector in self.XMLRoot.find('device').find('selectorlist'):
-      Domoticz.Log('selector id: ' + selector.get('id') + ', value: ' + selector.get('value') + ', name: ' + selector.get('name'))
-    Domoticz.Log('presetlist: ' + (self.XMLRoot.find('device').find('presetlist')).get('count'))
-    for preset in self.XMLRoot.find('device').find('presetlist'):
-      Domoticz.Log('preset id: ' + preset.get('id') + ', band: ' + preset.get('band') + ', freq: ' + preset.get('freq') + ', name: ' + preset.get('name'))
-    for control in self.XMLRoot.find('device').find('controllist'):
-      if (control.get('id')[0:3] == 'LMD'):
-        Domoticz.Log('control id: ' + control.get('id')[4:] + ', code: ' + control.get('code'))
+      objReceiver.onCommand(Unit, Command, Level, Hue)
+    self.updateHeartbeat()
+
+  def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
+    _log.debug('plugin', 'Notification: %s,%s,%s,%s,%s,%s,%s', Name, Subject, Text, Status, Priority, Sound, ImageFile)
+
+  def onDisconnect(self, Connection):
+    if (self.objFeed.isConnection(Connection) == True):
+      self.objFeed.onDisconnect(Connection)
+      return
+    objReceiver = self.dictConnections.get(Connection.Name)
+    if (objReceiver != None):
+      objReceiver.onDisconnect(Connection)
+      if (objReceiver.intState == ReceiverState.LOST):
+        self.objDiscovery.start()            # Find it again, without waiting for the backoff
+      self.updateHeartbeat()
+
+  def onHeartbeat(self):
+    _log.debug('plugin', 'onHeartbeat called')
+    if (self.objDiscovery.running() == False):
+      self.objDiscovery.start()
+    self.receiveModels()
+    self.objScheduler.runDue()
+    _log.flush()
+    self.updateHeartbeat()
+
+  def updateHeartbeat(self):
+    # Ask Domoticz to wake us up when the next task is due
+    fltDelay = self.objScheduler.nextDelay()
+    if (self.objModelWorker.pending() == True):
+      intHeartbeat = 1                       # Pick up the model as soon as the worker is done
+    elif (fltDelay == None):
+      intHeartbeat = HEARTBEAT_MAX
+    else:
+      intHeartbeat = min(max(int(math.ceil(fltDelay)), 1), HEARTBEAT_MAX)
+    if (intHeartbeat != self.intHeartbeat):
+      self.intHeartbeat = intHeartbeat
+      Domoticz.Heartbeat(intHeartbeat)
+
+  def receiveModels(self):
+    # Hand the models the worker built to their receivers
+    for strMAC, objModel, strError, fltSeconds in self.objModelWorker.results():
+      objReceiver = self.dictReceivers.get(strMAC)
+      if (objReceiver != None):
+        objReceiver.receiverInformation(objModel, strError, fltSeconds)
+
+  def receiverFound(self, strIPAddress, strModel, strPort, strRegion, strMAC):
+    objReceiver = self.dictReceivers.get(strMAC)
+    if (objReceiver == None):
+      intUnitBase = self.allocateUnitBase(strMAC)
+      if (intUnitBase == None):
+        return
+      objReceiver = Receiver(strMAC, intUnitBase, self.fltCommandInterval, self.objScheduler, self.objMetrics, self.objFeed, \
+                                     self.listMacros, self.objModelWorker)
+      self.dictReceivers[strMAC] = objReceiver
+      self.dictConnections[objReceiver.getConnectionName()] = objReceiver
+    objReceiver.found(strIPAddress, strModel, strPort, strRegion)
+    self.updateHeartbeat()
+
+  def reportMetrics(self):
+    # Log the metrics of the last window, show them on the devices and start a new window
+    strSummary = self.objMetrics.summary()
+    _log.info('Onkyo metrics: %s', strSummary)
+    if (self.blMetricDevices == True):
+      fltSeconds = max(time.time() - self.objMetrics.fltWindowStart, 1)
+      UpdateDevice(METRICS_FRAMES, 0, '%.1f' % (self.objMetrics.total('rx.')*60/fltSeconds))
+      UpdateDevice(METRICS_DISPATCH, 0, '%.1f' % self.objMetrics.histogram('dispatch').percentile(0.95))
+      UpdateDevice(METRICS_ROUNDTRIP, 0, '%.1f' % self.objMetrics.histogram('roundtrip').percentile(0.95))
+      UpdateDevice(METRICS_SUMMARY, 0, strSummary)
+    self.objMetrics.reset()
+    self.objScheduler.schedule('metrics', METRICS_INTERVAL, self.reportMetrics)
+
+  def checkMetricDevices(self):
+    if (METRICS_FRAMES not in Devices):
+      Domoticz.Device(Name="Onkyo frames received", Unit=METRICS_FRAMES, TypeName="Custom", \
+        Options={"Custom": "1;frames/min"}, Used=1).Create()
+    if (METRICS_DISPATCH not in Devices):
+      Domoticz.Device(Name="Onkyo dispatch time p95", Unit=METRICS_DISPATCH, TypeName="Custom", \
+        Options={"Custom": "1;ms"}, Used=1).Create()
+    if (METRICS_ROUNDTRIP not in Devices):
+      Domoticz.Device(Name="Onkyo round trip time p95", Unit=METRICS_ROUNDTRIP, TypeName="Custom", \
+        Options={"Custom": "1;ms"}, Used=1).Create()
+    if (METRICS_SUMMARY not in Devices):
+      Domoticz.Device(Name="Onkyo metrics", Unit=METRICS_SUMMARY, TypeName="Text", Used=1).Create()
+
+  def loadMacros(self, strMacros):
+    # Mode2 holds the macros, or the name of a file in the home folder with one macro per line
+    strMacros = strMacros.strip()
+    if (strMacros == ''):
+      return
+    strFile = os.path.join(Parameters["HomeFolder"], strMacros)
+    if (os.path.isfile(strFile) == True):
+      try:
+        with open(strFile, 'r') as f:
+          strMacros = f.read()
+      except IOError:
+        _log.error('Could not read the macro file: %s', strFile)
+        return
+    self.listMacros = parseMacros(strMacros)
+    for strName, listSteps in self.listMacros:
+      _log.debug('commands', 'Macro %s: %s', strName, listSteps)
+      prebuildISCPFrames([value for strStep, value in listSteps if strStep == 'send'])
+
+  def getUnitReceiver(self, Unit):
+    # The receiver that owns this unit
+    intUnitBase = ((Unit-1) // UNITS_PER_RECEIVER) * UNITS_PER_RECEIVER
+    for objReceiver in self.dictReceivers.values():
+      if (objReceiver.intUnitBase == intUnitBase):
+        return objReceiver
+    return None
+
+  def allocateUnitBase(self, strMAC):
+    # Every receiver gets its own block of UNITS_PER_RECEIVER units, the first receiver keeps the
+    # units 1..8 that were used when the plugin only supported a single receiver.
+    if (strMAC in self.dictUnitBases):
+      return self.dictUnitBases[strMAC]
+    listUsed = list(self.dictUnitBases.values())
+    for intIndex in range(0, MAX_RECEIVERS):
+      if (intIndex*UNITS_PER_RECEIVER not in listUsed):
+        self.dictUnitBases[strMAC] = intIndex*UNITS_PER_RECEIVER
+        self.saveUnitBases()
+        return intIndex*UNITS_PER_RECEIVER
+    _log.info('Receiver %s ignored, no more than %d receivers are supported', strMAC, MAX_RECEIVERS)
+    return None
+
+  def getUnitBaseFile(self):
+    return os.path.join(Parameters["HomeFolder"], 'Onkyo-units.cache')
+
+  def loadUnitBases(self):
+    try:
+      with open(self.getUnitBaseFile(), 'rb') as f:
+        self.dictUnitBases = dict(pickle.load(f))
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+      self.dictUnitBases = {}
+
+  def saveUnitBases(self):
+    try:
+      with open(self.getUnitBaseFile(), 'wb') as f:
+        pickle.dump(self.dictUnitBases, f, pickle.HIGHEST_PROTOCOL)
+    except IOError:
+      _log.error('Could not write the receiver unit allocation: %s', self.getUnitBaseFile())
 
 global _plugin
 _plugin = Onkyo()
+_log = PluginLog()
 
 def onStart():
     global _plugin
@@ -673,55 +2201,150 @@ def DumpConfigToLog():
         Domoticz.Log("Onkyo: Device LastLevel: " + str(Devices[x].LastLevel))
     return
 
-def createISCPFrame(message):
-  ISCPFrame = bytes(MESSAGE_HEADER_1+chr(len(message)+1)+MESSAGE_HEADER_2+message+MESSAGE_TRAILER, 'UTF-8')
-  return ISCPFrame
+def buildISCPFrame(strMessage):
+  bData = strMessage.encode('utf-8') + MESSAGE_TRAILER
+  return ISCP_FRAME_HEADER.pack(b'ISCP', ISCP_MIN_HEADER_SIZE, len(bData), ISCP_VERSION) + bData
+
+dictFrameCache = {}                          # Message -> complete frame, for every message we send often
+
+def createISCPFrame(strMessage):
+  bFrame = dictFrameCache.get(strMessage)
+  if (bFrame == None):
+    bFrame = buildISCPFrame(strMessage)
+  return bFrame
+
+def prebuildISCPFrames(listMessages):
+  for strMessage in listMessages:
+    if (strMessage not in dictFrameCache):
+      dictFrameCache[strMessage] = buildISCPFrame(strMessage)
+
+# The fixed commands and all state queries, the frames that depend on the model are added by the receivers
+prebuildISCPFrames([MESSAGE_DISCOVER, MESSAGE_RECEIVER_INFORMATION, MESSAGE_LISTENINGMODE + 'QSTN', MESSAGE_TUNERPRESET + 'QSTN'] + \
+                   ['!1' + strCommand + strValue for objZone in ZONES for strCommand in (objZone.strPower, objZone.strMute) \
+                                                 for strValue in ('00', '01', 'QSTN')] + \
+                   ['!1' + strCommand + 'QSTN' for objZone in ZONES for strCommand in (objZone.strVolume, objZone.strSource)])
+
+def parseMacros(strMacros):
+  # 'Movie: PWR01 SLI10 LMD04 MVL23; Music: PWR01, SLI2B' -> [(name, steps), ...]
+  # Macros are separated by ';' or new lines, steps are eISCP messages without the '!1' or
+  # delays like '500ms'. Lines that start with '#' are comments.
+  listMacros = []
+  for strDefinition in re.split(r'[;\n]', strMacros):
+    strDefinition = strDefinition.strip()
+    if (strDefinition == '') or (strDefinition[0] == '#'):
+      continue
+    strName, strSeparator, strSteps = strDefinition.partition(':')
+    strName = strName.strip()
+    if (strSeparator == '') or (strName == '') or ('|' in strName):
+      _log.error('Macro definition not understood: %s', strDefinition)
+      continue
+    listSteps = []
+    for strStep in re.split(r'[\s,]+', strSteps.strip().upper()):
+      objMatch = MACRO_STEP.match(strStep)
+      if (objMatch == None):
+        _log.error('Macro %s: step not understood: %s', strName, strStep)
+        listSteps = []
+        break
+      if (objMatch.group('delay') != None):
+        listSteps.append(('wait', int(objMatch.group('delay'))/1000))
+      else:
+        listSteps.append(('send', '!1' + objMatch.group('message')))
+    if (len(listSteps) > 0):
+      listMacros.append((strName, listSteps))
+  return listMacros
+
+def selectorOptions(listNames, strStyle):
+  # Options of a selector switch device with a hidden 'Off' level and a level for every name
+  return {"LevelActions": '|'*len(listNames), \
+          "LevelNames": '|'.join(['Off'] + listNames), \
+          "LevelOffHidden": "true", \
+          "SelectorStyle": strStyle}
+
+def controlLevelName(intValue):
+  # Name of a value in the level names of a tone or level control selector
+  if (intValue == 0):
+    return '0'
+  return '%+d' % intValue
+
+def controlValue(intValue):
+  # A tone or level value as the receiver expects it: '-A', '00', '+2'
+  if (intValue == 0):
+    return '00'
+  return '%+X' % intValue
+
+def presetLevelName(strId, strName):
+  # Name of a tuner preset in the level names of the tuner preset selector
+  return str(int('0x'+strId,16))+' '+strName
 
 def UpdateDevice(Unit, nValue, sValue):
     # Make sure that the Domoticz device still exists (they can be deleted) before updating it 
     if (Unit in Devices):
-      Domoticz.Log("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Unit].Name+")")
       if (Devices[Unit].nValue != nValue) or (Devices[Unit].sValue != sValue):
+        _log.debug('devices', "Update %s:'%s' (%s)", nValue, sValue, Devices[Unit].Name)
         Devices[Unit].Update(nValue, str(sValue))
 
-def setSelectorByName(intId, strName):
-  dictOptions = Devices[intId].Options
-  listLevelNames = dictOptions['LevelNames'].split('|')
-  intLevel = 0
-  for strLevelName in listLevelNames:
-    if strLevelName == strName:
-      Devices[intId].Update(1,str(intLevel))
-    intLevel += 10
-
-def setSelectorByCode(intId, strCode):
-  Domoticz.Log("Onkyo: setSelectorByCode code: "+strCode)
-  dictOptions = Devices[intId].Options
-  Domoticz.Log("Onkyo: Fetched Options")
-  Domoticz.Log("Onkyo: options: "+dictOptions['LevelNames'])
-  listLevelNames = dictOptions['LevelNames'].split('|')
-  intLevel = 0
-  Domoticz.Log("Onkyo: Starting Loop")
-  for strLevelName in listLevelNames:
-    Domoticz.Log(strLevelName[1:3])
-    if strLevelName[1:3] == strCode:
-      Domoticz.Log("Onkyo: found level: +"+str(intLevel))
-      Devices[intId].Update(1,str(intLevel))
-      return True
-    intLevel += 10
-  return False
-
-def addListeningMode(strCode):
-  nValue = Devices[MAINLISTENINGMODE].nValue
-  sValue = Devices[MAINLISTENINGMODE].sValue
-  dictOptions = Devices[MAINLISTENINGMODE].Options 
-  Domoticz.Log(dictOptions["LevelActions"])
-  Domoticz.Log(dictOptions["LevelNames"])
+class SelectorIndex:
+  # Level lookups for a selector switch device, built from its LevelNames option
+
+  def __init__(self, strLevelNames):
+    self.dictLevel = {}                      # Level name -> level
+    self.dictName = {}                       # Level -> level name
+    self.dictCode = {}                       # Code of an added listening mode ('[8C] New') -> level
+    intLevel = 0
+    for strLevelName in strLevelNames.split('|'):
+      self.dictLevel.setdefault(strLevelName, intLevel)
+      self.dictName[intLevel] = strLevelName
+      if (strLevelName[0:1] == '['):
+        self.dictCode.setdefault(strLevelName[1:3], intLevel)
+      intLevel += 10
+
+dictSelectorIndexes = {}                     # Unit -> SelectorIndex, rebuilt when the Options of the device change
+
+def getSelectorIndex(intId):
+  objIndex = dictSelectorIndexes.get(intId)
+  if (objIndex == None):
+    objIndex = SelectorIndex(Devices[intId].Options['LevelNames'])
+    dictSelectorIndexes[intId] = objIndex
+  return objIndex
+
+def invalidateSelectorIndex(intId=None):
+  if (intId == None):
+    dictSelectorIndexes.clear()
+  else:
+    dictSelectorIndexes.pop(intId, None)
+
+def getSelectorName(intId, Level):
+  return getSelectorIndex(intId).dictName.get(int(Level))
+
+def setSelectorByName(intId, strName, objCache):
+  if (intId not in Devices):
+    return False
+  intLevel = getSelectorIndex(intId).dictLevel.get(strName)
+  if (intLevel == None):
+    return False
+  objCache.update(intId, 1, str(intLevel))
+  return True
+
+def setSelectorByCode(intId, strCode, objCache):
+  if (intId not in Devices):
+    return False
+  intLevel = getSelectorIndex(intId).dictCode.get(strCode)
+  if (intLevel == None):
+    return False
+  objCache.update(intId, 1, str(intLevel))
+  return True
+
+def addListeningMode(intId, strCode):
+  nValue = Devices[intId].nValue
+  sValue = Devices[intId].sValue
+  dictOptions = Devices[intId].Options 
   dictOptions["LevelNames"] = dictOptions["LevelNames"]+'|['+strCode+']'+' New'
   dictOptions["LevelActions"] = dictOptions["LevelActions"]+'|'
-  Domoticz.Log(dictOptions["LevelActions"])
-  Domoticz.Log(dictOptions["LevelNames"])
+  _log.info('Added unknown listening mode %s to %s', strCode, Devices[intId].Name)
+  _log.debug('devices', 'Level names: %s', dictOptions["LevelNames"])
 
-  Devices[MAINLISTENINGMODE].Update(nValue = nValue, sValue = sValue, Options = dictOptions) 
+  Devices[intId].Update(nValue = nValue, sValue = sValue, Options = dictOptions) 
+  invalidateSelectorIndex(intId)
 
 #  Domoticz.Device(Name=(self.XMLRoot.find('device')).find('model').text + \
 #            ' ' + zone.get('name') + " Mode", Unit=MAINLISTENINGMODE, \
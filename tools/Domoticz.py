@@ -0,0 +1,98 @@
+# Stand-in for the Domoticz plugin API, to run plugin.py outside of Domoticz
+#
+# Only what the plugin uses is implemented. Nothing goes over the network: frames send on a
+# Connection are kept in its listSent, and the tools call the plugin callbacks themselves.
+#
+Devices = {}                                 # Unit -> Device, the plugin gets this as its Devices global
+listLog = []                                 # Everything the plugin logged, when blKeepLog is set
+blKeepLog = False
+intHeartbeat = 10                            # Last heartbeat interval the plugin asked for
+intDebugging = 0
+
+def Log(strMessage):
+  if (blKeepLog == True):
+    listLog.append(strMessage)
+
+def Error(strMessage):
+  if (blKeepLog == True):
+    listLog.append('Error: ' + strMessage)
+
+def Debug(strMessage):
+  if (blKeepLog == True) and (intDebugging != 0):
+    listLog.append(strMessage)
+
+def Debugging(intLevel):
+  global intDebugging
+  intDebugging = intLevel
+
+def Heartbeat(intSeconds):
+  global intHeartbeat
+  intHeartbeat = intSeconds
+
+class Connection:
+
+  def __init__(self, Name, Transport, Protocol, Address='', Port=''):
+    self.Name = Name
+    self.Transport = Transport
+    self.Protocol = Protocol
+    self.Address = Address
+    self.Port = Port
+    self.listSent = []                       # Messages passed to Send, in order
+    self.blConnected = False
+    self.blListening = False
+    self.fnSend = None                       # Optional callback for every message that is send
+
+  def Connect(self):
+    self.blConnected = True
+
+  def Listen(self):
+    self.blListening = True
+
+  def Send(self, Message, Delay=0):
+    self.listSent.append(Message)
+    if (self.fnSend != None):
+      self.fnSend(self, Message)
+
+  def Disconnect(self):
+    self.blConnected = False
+    self.blListening = False
+
+  def Connected(self):
+    return self.blConnected
+
+  def Connecting(self):
+    return False
+
+class Device:
+
+  def __init__(self, Name='', Unit=0, TypeName='', Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0, DeviceID=''):
+    self.Name = Name
+    self.Unit = Unit
+    self.ID = Unit
+    self.TypeName = TypeName
+    self.Type = Type
+    self.SubType = Subtype
+    self.SwitchType = Switchtype
+    self.Image = Image
+    self.Options = dict(Options or {})
+    self.Used = Used
+    self.nValue = 0
+    self.sValue = ''
+    self.LastLevel = 0
+    self.intUpdates = 0                      # Number of times Update was called
+
+  def Create(self):
+    Devices[self.Unit] = self
+
+  def Update(self, nValue, sValue, Options=None, **kwargs):
+    self.nValue = nValue
+    self.sValue = sValue
+    if (Options != None):
+      self.Options = dict(Options)
+    self.intUpdates += 1
+
+  def Delete(self):
+    Devices.pop(self.Unit, None)
+
+  def __str__(self):
+    return "Unit: " + str(self.Unit) + ", Name: '" + self.Name + "', nValue: " + str(self.nValue) + ", sValue: '" + self.sValue + "'"
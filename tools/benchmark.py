@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Offline benchmark of the plugin
+#
+# Runs plugin.py against the Domoticz stand-in in this folder, brings a receiver to the READY
+# state and replays the streams of corpus.py through onMessage and a series of commands through
+# onCommand. For every stream it reports frames per second, the latency of the onMessage or
+# onCommand calls and the memory allocated while replaying (peak and retained, from tracemalloc).
+#
+#   python3 tools/benchmark.py [--repeat N] [--interval MS] [--stream NAME ...] [--json FILE]
+#
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+strToolsFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(strToolsFolder))
+sys.path.insert(0, strToolsFolder)           # The stand-in must be found before a real Domoticz module
+import Domoticz
+import corpus
+import plugin
+
+MAC = '0009B0123456'
+STATES = ('PWR01', 'AMT00', 'MVL20', 'SLI01', 'LMD00', 'PRS01', 'ZPW01', 'ZMT00', 'ZVL20', 'SLZ01', \
+          'PW300', 'MT300', 'VL320', 'SL301', 'TFRB00T00', 'CTL00', 'SWL00')
+
+def startPlugin(strHomeFolder, intInterval):
+  # A fresh plugin instance with one receiver that is connected and in sync
+  Domoticz.Devices.clear()
+  plugin.invalidateSelectorIndex()
+  plugin.Devices = Domoticz.Devices
+  plugin.Parameters = {"HomeFolder": strHomeFolder, "Mode1": str(intInterval), "Mode2": "", "Mode3": "", \
+                       "Mode4": "Off", "Mode5": "", "Mode6": "Normal"}
+  plugin._log = plugin.PluginLog()
+  plugin._plugin = plugin.Onkyo()
+  objPlugin = plugin._plugin
+  plugin.onStart()
+  objDiscovery = objPlugin.objDiscovery.objConnection
+  objResponse = Domoticz.Connection(Name=objDiscovery.Name, Transport="UDP/IP", Protocol="None", Address="127.0.0.1", Port="60128")
+  plugin.onMessage(objResponse, corpus.ecn(strMAC=MAC), 0, None)
+  objReceiver = objPlugin.dictReceivers[MAC]
+  plugin.onConnect(objReceiver.objConnection, 0, '')
+  plugin.onMessage(objReceiver.objConnection, corpus.nriFrames(((10, 40, 20),), strMAC=MAC)[0], 0, None)
+  while (objPlugin.objModelWorker.pending() == True):   # The XML is parsed on the worker thread
+    time.sleep(0.001)
+    objPlugin.receiveModels()
+  plugin.onMessage(objReceiver.objConnection, b''.join([corpus.frame(strState) for strState in STATES]), 0, None)
+  if (objReceiver.intState != plugin.ReceiverState.READY):
+    raise RuntimeError('Receiver did not get ready, state ' + str(objReceiver.intState))
+  return objPlugin, objReceiver
+
+def messageReplay(listChunks):
+  def replay(objPlugin, objReceiver):
+    listTimes = []
+    for bChunk in listChunks:
+      fltStart = time.perf_counter()
+      plugin.onMessage(objReceiver.objConnection, bChunk, 0, None)
+      objPlugin.objScheduler.runDue()
+      listTimes.append(time.perf_counter() - fltStart)
+    return listTimes
+  return replay, b''.join(listChunks).count(b'ISCP')
+
+def commandReplay(intOffset, strCommand, listLevels):
+  def replay(objPlugin, objReceiver):
+    listTimes = []
+    intUnit = objReceiver.unit(intOffset)
+    for intLevel in listLevels:
+      fltStart = time.perf_counter()
+      plugin.onCommand(intUnit, strCommand, intLevel, 0)
+      objPlugin.objScheduler.runDue()
+      listTimes.append(time.perf_counter() - fltStart)
+    return listTimes
+  return replay, len(listLevels)
+
+def scenarios():
+  dictScenarios = {}
+  for strName, listChunks in corpus.streams().items():
+    dictScenarios[strName] = messageReplay(listChunks)
+  dictScenarios['command-volume'] = commandReplay(plugin.MAINVOLUME, 'Set Level', [intLevel % 101 for intLevel in range(0, 500)])
+  dictScenarios['command-source'] = commandReplay(plugin.MAINSOURCE, 'Set Level', [10 + (intLevel % 10)*10 for intLevel in range(0, 500)])
+  return dictScenarios
+
+def percentile(listValues, fltFraction):
+  listSorted = sorted(listValues)
+  return listSorted[min(int(len(listSorted)*fltFraction), len(listSorted)-1)]
+
+def run(strName, fnReplay, intFrames, intRepeat, intInterval, strHomeFolder):
+  listBest = None
+  for intRun in range(0, intRepeat):
+    objPlugin, objReceiver = startPlugin(strHomeFolder, intInterval)
+    listTimes = fnReplay(objPlugin, objReceiver)
+    if (listBest == None) or (sum(listTimes) < sum(listBest)):
+      listBest = listTimes
+  objPlugin, objReceiver = startPlugin(strHomeFolder, intInterval)
+  tracemalloc.start()
+  intStart = tracemalloc.get_traced_memory()[0]
+  fnReplay(objPlugin, objReceiver)
+  intCurrent, intPeak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  fltTotal = sum(listBest)
+  return {'stream': strName, \
+          'calls': len(listBest), \
+          'frames': intFrames, \
+          'frames_per_second': intFrames/fltTotal if fltTotal > 0 else 0, \
+          'us_per_frame': fltTotal*1e6/max(intFrames, 1), \
+          'p50_us': percentile(listBest, 0.5)*1e6, \
+          'p95_us': percentile(listBest, 0.95)*1e6, \
+          'max_us': max(listBest)*1e6, \
+          'peak_kib': (intPeak-intStart)/1024, \
+          'retained_kib': (intCurrent-intStart)/1024}
+
+def main():
+  objParser = argparse.ArgumentParser(description='Replay recorded and synthetic eISCP traffic through the plugin')
+  objParser.add_argument('--repeat', type=int, default=5, help='runs per stream, the fastest one is reported')
+  objParser.add_argument('--interval', type=int, default=0, help='command interval in ms (Mode1), 0 sends commands right away')
+  objParser.add_argument('--stream', action='append', help='only run this stream, can be repeated')
+  objParser.add_argument('--json', help='also write the results to this file')
+  args = objParser.parse_args()
+  if (args.json != None):
+    args.json = os.path.abspath(args.json)
+
+  dictScenarios = scenarios()
+  listNames = args.stream or list(dictScenarios)
+  strHomeFolder = tempfile.mkdtemp(prefix='onkyo-bench-')
+  listResults = []
+  print('%-16s %6s %6s %12s %10s %10s %10s %10s %10s %10s' % \
+        ('stream', 'calls', 'frames', 'frames/s', 'us/frame', 'p50 us', 'p95 us', 'max us', 'peak KiB', 'kept KiB'))
+  for strName in listNames:
+    fnReplay, intFrames = dictScenarios[strName]
+    dictResult = run(strName, fnReplay, intFrames, args.repeat, args.interval, strHomeFolder)
+    listResults.append(dictResult)
+    print('%-16s %6d %6d %12.0f %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f' % \
+          (strName, dictResult['calls'], dictResult['frames'], dictResult['frames_per_second'], dictResult['us_per_frame'], \
+           dictResult['p50_us'], dictResult['p95_us'], dictResult['max_us'], dictResult['peak_kib'], dictResult['retained_kib']))
+  if (args.json != None):
+    with open(args.json, 'w') as f:
+      json.dump(listResults, f, indent=2)
+
+if __name__ == '__main__':
+  main()
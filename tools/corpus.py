@@ -0,0 +1,141 @@
+# Synthetic eISCP traffic for the benchmark and the simulator
+#
+# Every stream is a list of byte strings, each one is what a single onMessage call receives.
+#
+import random
+import struct
+
+ISCP_HEADER = struct.Struct('>4sIIB3x')      # 'ISCP', header size, data size, version
+
+def frame(strMessage, strUnit='1'):
+  # eISCP frame as a receiver sends it: !<unit><command><parameter> EOF CR LF
+  bData = ('!' + strUnit + strMessage).encode('utf-8') + b'\x1a\r\n'
+  return ISCP_HEADER.pack(b'ISCP', 16, len(bData), 1) + bData
+
+def parse(bBuffer):
+  # Split complete frames off the front of bBuffer, returns ([(unit, message), ...], rest of the buffer)
+  listMessages = []
+  while True:
+    intStart = bBuffer.find(b'ISCP')
+    if (intStart < 0) or (len(bBuffer) - intStart < 16):
+      break
+    strMagic, intHeaderSize, intDataSize, intVersion = ISCP_HEADER.unpack_from(bBuffer, intStart)
+    intEnd = intStart + intHeaderSize + intDataSize
+    if (len(bBuffer) < intEnd):
+      break
+    strData = bBuffer[intStart+intHeaderSize:intEnd].decode('utf-8', 'ignore').rstrip('\x1a\r\n')
+    bBuffer = bBuffer[intEnd:]
+    if (strData[0:1] == '!') and (len(strData) >= 5):
+      listMessages.append((strData[1], strData[2:]))
+  return listMessages, bBuffer
+
+def nriXML(strModel='TX-NR646', strMAC='0009B0123456', intSelectors=10, intPresets=40, intModes=20):
+  # Receiver information in the layout of the NRI answer, larger models have longer lists
+  listXML = ['<?xml version="1.0" encoding="utf-8"?><response status="ok"><device id="' + strModel + '">', \
+             '<brand>ONKYO</brand><category>AV Receiver</category><year>2016</year><model>' + strModel + '</model>', \
+             '<destination>Dx</destination><macaddress>' + strMAC + '</macaddress>', \
+             '<firmwareversion>1000-0000-0000-0010</firmwareversion>', \
+             '<netservicelist count="1"><netservice id="0e" value="1" name="TuneIn"/></netservicelist>', \
+             '<zonelist count="4"><zone id="1" value="1" name="Main" volmax="80" volstep="0"/>' + \
+             '<zone id="2" value="1" name="Zone2" volmax="80" volstep="0"/><zone id="3" value="1" name="Zone3" volmax="80" volstep="0"/>' + \
+             '<zone id="4" value="0" name="Zone4" volmax="0" volstep="0"/></zonelist>', \
+             '<selectorlist count="' + str(intSelectors) + '">']
+  for intIndex in range(0, intSelectors):
+    listXML.append('<selector id="%02X" value="1" name="Input %d" zone="03" iconid="%02X"/>' % (intIndex, intIndex+1, intIndex))
+  listXML.append('</selectorlist><presetlist count="' + str(intPresets) + '">')
+  for intIndex in range(1, intPresets+1):
+    listXML.append('<preset id="%02X" band="1" freq="%.2f" name="Radio %d"/>' % (intIndex, 87.5+intIndex*0.2, intIndex))
+  listXML.append('</presetlist><controllist count="' + str(intModes+4) + '">')
+  for strControl, intMin, intMax in (('Bass', -10, 10), ('Treble', -10, 10), ('Center Level', -12, 12), ('Subwoofer Level', -15, 12)):
+    listXML.append('<control id="%s" value="1" zone="1" min="%d" max="%d" step="1"/>' % (strControl, intMin, intMax))
+  for intIndex in range(0, intModes):
+    listXML.append('<control id="LMD Mode %d" value="1" code="%02X" position="%d"/>' % (intIndex+1, intIndex, intIndex+1))
+  listXML.append('</controllist><functionlist count="0"/><tuners count="1"><tuner band="FM" min="87500" max="107900" step="50"/></tuners>')
+  listXML.append('</device></response>')
+  return ''.join(listXML)
+
+def ecn(strModel='TX-NR646', strMAC='0009B0123456', intPort=60128):
+  # Answer to the discovery broadcast
+  return frame('ECN' + strModel + '/' + str(intPort) + '/DX/' + strMAC + '\x19')
+
+def volumeSweep(intSteps=500):
+  # One volume frame per onMessage, like a volume knob that is turned slowly
+  return [frame('MVL%02X' % (intStep % 81)) for intStep in range(0, intSteps)]
+
+def volumeBurst(intSteps=500, intPerChunk=25):
+  # Several volume frames per onMessage, like a volume knob that is turned fast
+  listFrames = volumeSweep(intSteps)
+  return [b''.join(listFrames[intIndex:intIndex+intPerChunk]) for intIndex in range(0, len(listFrames), intPerChunk)]
+
+def statusMix(intFrames=500, intSeed=1):
+  # The status a receiver pushes when it is operated from the remote control
+  objRandom = random.Random(intSeed)
+  listMessages = []
+  for intIndex in range(0, intFrames):
+    intKind = objRandom.randrange(0, 8)
+    if (intKind == 0):
+      listMessages.append('PWR0' + str(objRandom.randrange(0, 2)))
+    elif (intKind == 1):
+      listMessages.append('AMT0' + str(objRandom.randrange(0, 2)))
+    elif (intKind == 2):
+      listMessages.append('SLI%02X' % objRandom.randrange(0, 10))
+    elif (intKind == 3):
+      listMessages.append('LMD%02X' % objRandom.randrange(0, 24))   # Includes codes that are not in the XML
+    elif (intKind == 4):
+      listMessages.append('PRS%02X' % objRandom.randrange(1, 41))
+    elif (intKind == 5):
+      listMessages.append('ZVL%02X' % objRandom.randrange(0, 81))
+    elif (intKind == 6):
+      listMessages.append('SLZ%02X' % objRandom.randrange(0, 10))
+    else:
+      listMessages.append('NLT' + 'F3' * 30)          # Net status, no handler
+  return [frame(strMessage) for strMessage in listMessages]
+
+def netPlayback(intSeconds=300, intSeed=4):
+  # A network source playing: title, artist, album and cover art on every track change, the play time every second
+  objRandom = random.Random(intSeed)
+  listMessages = []
+  for intSecond in range(0, intSeconds):
+    if (intSecond % 60 == 0):
+      intTrack = intSecond // 60
+      listMessages += ['NTITrack %d' % intTrack, 'NATArtist %d' % (intTrack // 2), 'NALAlbum %d' % (intTrack // 2)]
+      bArt = bytes([objRandom.randrange(0, 256) for intIndex in range(0, 2000)]) if (intTrack % 2 == 0) else bArt
+      strArt = bArt.hex().upper()
+      listPackets = [strArt[intPos:intPos+1024] for intPos in range(0, len(strArt), 1024)]
+      for intIndex, strPacket in enumerate(listPackets):
+        listMessages.append('NJA1' + ('0' if intIndex == 0 else '2' if intIndex == len(listPackets)-1 else '1') + strPacket)
+    listMessages.append('NTM%02d:%02d/01:00' % ((intSecond % 60) // 60, intSecond % 60))
+  return [frame(strMessage) for strMessage in listMessages]
+
+def split(listChunks, intSeed=2, intMaxSize=7):
+  # The same bytes, cut at random places as TCP may deliver them
+  objRandom = random.Random(intSeed)
+  bStream = b''.join(listChunks)
+  listSplit = []
+  intPos = 0
+  while (intPos < len(bStream)):
+    intSize = objRandom.randrange(1, intMaxSize+1)
+    listSplit.append(bStream[intPos:intPos+intSize])
+    intPos += intSize
+  return listSplit
+
+def garbagePrefixed(listChunks, intSeed=3, intMaxGarbage=20):
+  # Every chunk preceded by bytes that are not an eISCP frame
+  objRandom = random.Random(intSeed)
+  return [bytes([objRandom.randrange(0, 256) for intIndex in range(0, objRandom.randrange(1, intMaxGarbage+1))]).replace(b'I', b'.') + bChunk \
+          for bChunk in listChunks]
+
+def nriFrames(tupleSizes=((5, 10, 10), (20, 40, 30), (40, 120, 60)), strMAC='0009B0123456'):
+  # NRI answers of a small, a medium and a large receiver
+  return [frame('NRI' + nriXML(strMAC=strMAC, intSelectors=intSelectors, intPresets=intPresets, intModes=intModes)) \
+          for intSelectors, intPresets, intModes in tupleSizes]
+
+def streams():
+  # Name -> list of chunks of every stream of the corpus
+  return {'volume-sweep': volumeSweep(), \
+          'volume-burst': volumeBurst(), \
+          'status-mix': statusMix(), \
+          'status-split': split(statusMix()), \
+          'status-garbage': garbagePrefixed(statusMix()), \
+          'net-playback': netPlayback(), \
+          'nri': nriFrames()}
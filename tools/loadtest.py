@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# End to end test of the plugin against the simulated receiver
+#
+# The connections of the Domoticz stand-in are replaced by real sockets and a small event
+# loop calls onConnect, onMessage, onDisconnect and onHeartbeat like Domoticz does. The
+# simulator runs in a thread of this process. Measured are the time from onStart to a receiver
+# in sync, the latency from onCommand to the echo of the receiver, and the throughput with the
+# receiver pushing status at a high rate.
+#
+#   python3 tools/loadtest.py [--commands 200] [--push-rate 2000] [--push-time 5] [--fragment 0]
+#
+import argparse
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import time
+
+strToolsFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(strToolsFolder))
+sys.path.insert(0, strToolsFolder)           # The stand-in must be found before a real Domoticz module
+import Domoticz
+import corpus
+import plugin
+import simulator
+
+objSelector = selectors.DefaultSelector()
+listCallbacks = []                           # Plugin callbacks waiting to be called from the loop, like Domoticz queues them
+intSimulatorUDPPort = 0
+StubConnection = Domoticz.Connection         # Domoticz.Connection is replaced by NetworkConnection in main()
+
+class NetworkConnection(StubConnection):
+  # Domoticz connection that uses a real socket
+
+  def __init__(self, Name, Transport, Protocol, Address='', Port=''):
+    StubConnection.__init__(self, Name, Transport, Protocol, Address, Port)
+    self.objSocket = None
+
+  def Connect(self):
+    self.objSocket = socket.create_connection((self.Address, int(self.Port)))
+    self.objSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.objSocket.setblocking(False)
+    objSelector.register(self.objSocket, selectors.EVENT_READ, self)
+    self.blConnected = True
+    listCallbacks.append((plugin.onConnect, (self, 0, '')))
+
+  def Listen(self):
+    self.objSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.objSocket.bind(('127.0.0.1', 0))
+    self.objSocket.setblocking(False)
+    objSelector.register(self.objSocket, selectors.EVENT_READ, self)
+    self.blListening = True
+
+  def Send(self, Message, Delay=0):
+    StubConnection.Send(self, Message, Delay)
+    if (self.Transport == "UDP/IP"):
+      self.objSocket.sendto(Message, ('127.0.0.1', intSimulatorUDPPort))   # The broadcast only reaches the simulator
+    else:
+      self.objSocket.sendall(Message)
+
+  def Disconnect(self):
+    if (self.objSocket != None):
+      objSelector.unregister(self.objSocket)
+      self.objSocket.close()
+      self.objSocket = None
+      if (self.Transport != "UDP/IP"):
+        listCallbacks.append((plugin.onDisconnect, (self,)))
+    StubConnection.Disconnect(self)
+
+  def receive(self):
+    if (self.Transport == "UDP/IP"):
+      bData, tupleAddress = self.objSocket.recvfrom(65536)
+      objFrom = StubConnection(self.Name, self.Transport, self.Protocol, tupleAddress[0], str(tupleAddress[1]))
+      plugin.onMessage(objFrom, bData, 0, None)
+      return 1
+    bData = self.objSocket.recv(65536)
+    if (len(bData) == 0):
+      self.Disconnect()
+      return 0
+    plugin.onMessage(self, bData, 0, None)
+    return 1
+
+class Loop:
+  # Calls the plugin like Domoticz does, and keeps time of what it calls
+
+  def __init__(self):
+    self.fltLastHeartbeat = time.monotonic()
+    self.fltMessageTime = 0                  # Time spend in onMessage
+    self.intMessages = 0
+
+  def runOnce(self, fltTimeout):
+    while (len(listCallbacks) > 0):
+      fnCallback, tupleArgs = listCallbacks.pop(0)
+      fnCallback(*tupleArgs)
+    fltNow = time.monotonic()
+    if (fltNow >= self.fltLastHeartbeat + Domoticz.intHeartbeat):   # The plugin may have changed the interval since the last one
+      self.fltLastHeartbeat = fltNow
+      plugin.onHeartbeat()
+    fltTimeout = max(min(fltTimeout, self.fltLastHeartbeat + Domoticz.intHeartbeat - fltNow), 0)
+    for objKey, intEvents in objSelector.select(fltTimeout):
+      fltStart = time.perf_counter()
+      self.intMessages += objKey.data.receive()
+      self.fltMessageTime += time.perf_counter() - fltStart
+
+  def runUntil(self, fnDone, fltTimeout):
+    fltEnd = time.monotonic() + fltTimeout
+    while (fnDone() == False):
+      if (time.monotonic() >= fltEnd):
+        return False
+      self.runOnce(0.05)
+    return True
+
+def main():
+  global intSimulatorUDPPort
+  objParser = argparse.ArgumentParser(description='Run the plugin against the simulated receiver')
+  objParser.add_argument('--commands', type=int, default=200, help='volume commands for the latency test')
+  objParser.add_argument('--interval', type=int, default=150, help='command interval in ms (Mode1)')
+  objParser.add_argument('--push-rate', type=float, default=2000, help='status messages per second for the throughput test')
+  objParser.add_argument('--push-time', type=float, default=5, help='seconds of the throughput test')
+  objParser.add_argument('--fragment', type=int, default=0, help='cut the frames of the simulator into TCP segments of at most this many bytes')
+  objParser.add_argument('--nri-size', choices=sorted(simulator.NRI_SIZES), default='medium')
+  args = objParser.parse_args()
+
+  strMAC = '0009B0123456'
+  intSelectors, intPresets, intModes = simulator.NRI_SIZES[args.nri_size]
+  objReceiver = simulator.SimulatedReceiver('TX-NR646', strMAC, corpus.nriXML('TX-NR646', strMAC, intSelectors, intPresets, intModes))
+  objSimulator = simulator.Simulator(objReceiver, '127.0.0.1', 0, 0, 0, args.fragment, 0)
+  objSimulator.runInThread()
+  intSimulatorUDPPort = objSimulator.intUDPPort
+
+  strHomeFolder = tempfile.mkdtemp(prefix='onkyo-load-')
+  Domoticz.Connection = NetworkConnection
+  plugin.Devices = Domoticz.Devices
+  plugin.Parameters = {"HomeFolder": strHomeFolder, "Mode1": str(args.interval), "Mode2": "", "Mode3": "", \
+                       "Mode4": "Log", "Mode5": "", "Mode6": "Normal"}
+  objLoop = Loop()
+  objPlugin = plugin._plugin
+
+  # Discovery, connect, receiver information and the state of the zones
+  fltStart = time.perf_counter()
+  plugin.onStart()
+  fnReady = lambda: (strMAC in objPlugin.dictReceivers) and (objPlugin.dictReceivers[strMAC].intState == plugin.ReceiverState.READY)
+  if (objLoop.runUntil(fnReady, 30) == False):
+    print('Receiver did not get ready')
+    sys.exit(1)
+  print('Ready after            %8.1f ms' % ((time.perf_counter() - fltStart)*1000))
+  objPluginReceiver = objPlugin.dictReceivers[strMAC]
+
+  # Command latency: wait for the echo of every volume command before sending the next one
+  intUnit = objPluginReceiver.unit(plugin.MAINVOLUME)
+  fltMaxVolume = objPluginReceiver.dictMaxVolume[intUnit]
+  listLatency = []
+  for intIndex in range(0, args.commands):
+    intLevel = 1 + intIndex % 100
+    strExpected = '%02X' % int((fltMaxVolume/100)*intLevel)
+    if (objReceiver.dictState['MVL'] == strExpected):
+      continue                               # No change, the receiver would still echo but it proves nothing
+    fltStart = time.perf_counter()
+    plugin.onCommand(intUnit, 'Set Level', intLevel, 0)
+    fnEchoed = lambda: (objPluginReceiver.objSendQueue.pending() == False) and \
+                       ((objPluginReceiver.getConnectionName(), 'MVL') not in objPlugin.objMetrics.dictSendTime)
+    if (objLoop.runUntil(fnEchoed, 5) == False):
+      print('No echo for volume ' + strExpected)
+      continue
+    listLatency.append(time.perf_counter() - fltStart)
+  if (len(listLatency) > 0):
+    listLatency.sort()
+    print('Command latency        p50 %.2f ms, p95 %.2f ms, max %.2f ms (%d commands)' % \
+          (listLatency[len(listLatency)//2]*1000, listLatency[min(int(len(listLatency)*0.95), len(listLatency)-1)]*1000, \
+           listLatency[-1]*1000, len(listLatency)))
+
+  # Throughput with the receiver pushing status
+  objPlugin.objMetrics.reset()
+  objLoop.fltMessageTime = 0
+  objLoop.intMessages = 0
+  objSimulator.setPushRate(args.push_rate)
+  fltStart = time.perf_counter()
+  fltEnd = time.monotonic() + args.push_time
+  while (time.monotonic() < fltEnd):
+    objLoop.runOnce(0.05)
+  objSimulator.setPushRate(0)
+  fltElapsed = time.perf_counter() - fltStart
+  intFrames = objPlugin.objMetrics.total('rx.')
+  print('Push throughput        %8.0f frames/s (%d frames in %d onMessage calls, %.1f%% of the time in onMessage)' % \
+        (intFrames/fltElapsed, intFrames, objLoop.intMessages, objLoop.fltMessageTime*100/fltElapsed))
+  print('Metrics                ' + objPlugin.objMetrics.summary())
+  plugin.onStop()
+
+if __name__ == '__main__':
+  main()
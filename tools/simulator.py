@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Simulated Onkyo receiver
+#
+# Answers the ECN discovery broadcast on UDP, serves eISCP on TCP, returns its receiver
+# information (NRI) and the state of its zones on QSTN, applies and echoes commands, and can
+# push unsolicited status at a fixed rate. Frames can be cut into small TCP segments to test
+# the reassembly in the plugin.
+#
+#   python3 tools/simulator.py [--udp-port 60128] [--tcp-port 60128] [--nri FILE | --nri-size medium]
+#                              [--push-rate 0] [--fragment 0] [--latency 0]
+#
+import argparse
+import asyncio
+import random
+import re
+import socket
+import threading
+import time
+
+import corpus
+
+NRI_SIZES = {'small': (5, 10, 10), 'medium': (10, 40, 20), 'large': (40, 120, 60)}
+INITIAL_STATE = {'PWR': '01', 'AMT': '00', 'MVL': '28', 'SLI': '01', 'LMD': '00', 'PRS': '01', \
+                 'ZPW': '00', 'ZMT': '00', 'ZVL': '20', 'SLZ': '01', \
+                 'PW3': '00', 'MT3': '00', 'VL3': '20', 'SL3': '01', \
+                 'TFR': 'B00T00', 'CTL': '00', 'SWL': '00'}
+VOLUME_COMMANDS = ('MVL', 'ZVL', 'VL3')
+TONE_COMMANDS = ('TFR',)                     # Bass and treble in one status, a command sets one of them
+
+class SimulatedReceiver:
+  # State of the receiver and the answers to the messages it gets
+
+  def __init__(self, strModel, strMAC, strNRI, intSeed=None):
+    self.strModel = strModel
+    self.strMAC = strMAC
+    self.strNRI = strNRI                     # XML returned for NRIQSTN
+    self.dictState = dict(INITIAL_STATE)     # Command -> current parameter
+    self.objRandom = random.Random(intSeed)
+    self.intReceived = 0                     # Messages received on TCP
+    self.intSent = 0                         # Messages send on TCP
+
+  def answer(self, strMessage):
+    # Messages to send back for one received message
+    strCommand = strMessage[0:3]
+    strParameter = strMessage[3:]
+    if (strCommand == 'NRI') and (strParameter == 'QSTN'):
+      return ['NRI' + self.strNRI]
+    if (strCommand not in self.dictState):
+      return [strCommand + 'N/A']
+    if (strParameter == 'QSTN'):
+      return [strCommand + self.dictState[strCommand]]
+    if (strCommand in VOLUME_COMMANDS) and (strParameter in ('UP', 'DOWN')):
+      intVolume = int(self.dictState[strCommand], 16) + (1 if strParameter == 'UP' else -1)
+      strParameter = '%02X' % min(max(intVolume, 0), 80)
+    if (strCommand in TONE_COMMANDS) and (strParameter[0:1] in ('B', 'T')):
+      dictTone = dict(re.findall(r'([BT])([-+][0-9A-F]+|00)', self.dictState[strCommand] + strParameter))
+      strParameter = 'B' + dictTone['B'] + 'T' + dictTone['T']
+    self.dictState[strCommand] = strParameter
+    return [strCommand + strParameter]
+
+  def randomStatus(self):
+    # A status change as if the receiver was operated from its remote control
+    strCommand = self.objRandom.choice(('MVL', 'MVL', 'MVL', 'ZVL', 'SLI', 'LMD', 'PRS', 'AMT'))
+    if (strCommand in VOLUME_COMMANDS):
+      strParameter = '%02X' % self.objRandom.randrange(0, 81)
+    elif (strCommand == 'AMT'):
+      strParameter = '0' + str(self.objRandom.randrange(0, 2))
+    elif (strCommand == 'PRS'):
+      strParameter = '%02X' % self.objRandom.randrange(1, 41)
+    else:
+      strParameter = '%02X' % self.objRandom.randrange(0, 10)
+    self.dictState[strCommand] = strParameter
+    return strCommand + strParameter
+
+class ISCPServerProtocol(asyncio.Protocol):
+  # One TCP client of the simulator
+
+  def __init__(self, objSimulator):
+    self.objSimulator = objSimulator
+    self.objTransport = None
+    self.bBuffer = b''
+    self.fltWriteTime = 0                    # Loop time of the last scheduled fragment, fragments must not overtake each other
+
+  def connection_made(self, transport):
+    self.objTransport = transport
+    objSocket = transport.get_extra_info('socket')
+    if (objSocket != None):
+      objSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.objSimulator.setClients.add(self)
+
+  def connection_lost(self, exc):
+    self.objSimulator.setClients.discard(self)
+
+  def data_received(self, data):
+    listMessages, self.bBuffer = corpus.parse(self.bBuffer + data)
+    listAnswers = []
+    for strUnit, strMessage in listMessages:
+      self.objSimulator.objReceiver.intReceived += 1
+      listAnswers += self.objSimulator.objReceiver.answer(strMessage)
+    if (len(listAnswers) > 0):
+      self.objSimulator.send(self, listAnswers, self.objSimulator.fltLatency)
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+
+  def __init__(self, objSimulator):
+    self.objSimulator = objSimulator
+    self.objTransport = None
+
+  def connection_made(self, transport):
+    self.objTransport = transport
+
+  def datagram_received(self, data, addr):
+    listMessages, bRest = corpus.parse(data)
+    for strUnit, strMessage in listMessages:
+      if (strMessage == 'ECNQSTN'):
+        objReceiver = self.objSimulator.objReceiver
+        self.objTransport.sendto(corpus.ecn(objReceiver.strModel, objReceiver.strMAC, self.objSimulator.intTCPPort), addr)
+
+class Simulator:
+  # The servers of one simulated receiver, on its own asyncio loop
+
+  def __init__(self, objReceiver, strHost='0.0.0.0', intUDPPort=60128, intTCPPort=60128, fltPushRate=0, intFragment=0, fltLatency=0):
+    self.objReceiver = objReceiver
+    self.strHost = strHost
+    self.intUDPPort = intUDPPort             # 0 picks a free port, the port in use is set by start()
+    self.intTCPPort = intTCPPort
+    self.fltPushRate = fltPushRate           # Unsolicited status messages per second, 0 for none
+    self.intFragment = intFragment           # Largest TCP segment in bytes, 0 to send every answer in one write
+    self.fltLatency = fltLatency             # Seconds before an answer is send
+    self.setClients = set()
+    self.objLoop = None
+    self.objRandom = random.Random(1)
+
+  async def start(self):
+    self.objLoop = asyncio.get_running_loop()
+    objServer = await self.objLoop.create_server(lambda: ISCPServerProtocol(self), self.strHost, self.intTCPPort)
+    self.intTCPPort = objServer.sockets[0].getsockname()[1]
+    objTransport, objProtocol = await self.objLoop.create_datagram_endpoint(lambda: DiscoveryProtocol(self), \
+                                                                           local_addr=(self.strHost, self.intUDPPort), allow_broadcast=True)
+    self.intUDPPort = objTransport.get_extra_info('sockname')[1]
+    self.objLoop.create_task(self.push())
+
+  def send(self, objClient, listMessages, fltDelay=0):
+    bData = b''.join([corpus.frame(strMessage) for strMessage in listMessages])
+    self.objReceiver.intSent += len(listMessages)
+    if (self.intFragment <= 0):
+      self.objLoop.call_later(fltDelay, self.write, objClient, bData)
+      return
+    fltWriteTime = max(self.objLoop.time() + fltDelay, objClient.fltWriteTime)
+    intPos = 0
+    while (intPos < len(bData)):
+      intSize = self.objRandom.randrange(1, self.intFragment+1)
+      fltWriteTime += 0.0002                 # Separate writes, so they arrive as separate segments
+      self.objLoop.call_at(fltWriteTime, self.write, objClient, bData[intPos:intPos+intSize])
+      intPos += intSize
+    objClient.fltWriteTime = fltWriteTime
+
+  def write(self, objClient, bData):
+    if (objClient.objTransport != None) and (objClient.objTransport.is_closing() == False):
+      objClient.objTransport.write(bData)
+
+  async def push(self):
+    fltNext = time.monotonic()
+    while True:
+      if (self.fltPushRate <= 0) or (len(self.setClients) == 0):
+        await asyncio.sleep(0.1)
+        fltNext = time.monotonic()
+        continue
+      fltNext += 1/self.fltPushRate
+      strMessage = self.objReceiver.randomStatus()
+      for objClient in list(self.setClients):
+        self.send(objClient, [strMessage])
+      await asyncio.sleep(max(fltNext - time.monotonic(), 0))
+
+  def setPushRate(self, fltPushRate):
+    # Can be called from another thread
+    self.objLoop.call_soon_threadsafe(setattr, self, 'fltPushRate', fltPushRate)
+
+  def runInThread(self):
+    # Start the simulator on a loop in a daemon thread, returns once the ports are open
+    objStarted = threading.Event()
+    def run():
+      objLoop = asyncio.new_event_loop()
+      asyncio.set_event_loop(objLoop)
+      objLoop.run_until_complete(self.start())
+      objStarted.set()
+      objLoop.run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    objStarted.wait()
+
+def nriFromArguments(args):
+  if (args.nri != None):
+    with open(args.nri, 'r') as f:
+      return f.read()
+  intSelectors, intPresets, intModes = NRI_SIZES[args.nri_size]
+  return corpus.nriXML(args.model, args.mac, intSelectors, intPresets, intModes)
+
+def main():
+  objParser = argparse.ArgumentParser(description='Simulated Onkyo receiver')
+  objParser.add_argument('--host', default='0.0.0.0')
+  objParser.add_argument('--udp-port', type=int, default=60128, help='discovery port')
+  objParser.add_argument('--tcp-port', type=int, default=60128, help='eISCP port')
+  objParser.add_argument('--model', default='TX-NR646')
+  objParser.add_argument('--mac', default='0009B0123456')
+  objParser.add_argument('--nri', help='file with the XML to return for NRIQSTN')
+  objParser.add_argument('--nri-size', choices=sorted(NRI_SIZES), default='medium', help='size of the generated XML')
+  objParser.add_argument('--push-rate', type=float, default=0, help='unsolicited status messages per second')
+  objParser.add_argument('--fragment', type=int, default=0, help='cut frames into TCP segments of at most this many bytes')
+  objParser.add_argument('--latency', type=float, default=0, help='ms before an answer is send')
+  args = objParser.parse_args()
+
+  objReceiver = SimulatedReceiver(args.model, args.mac, nriFromArguments(args))
+  objSimulator = Simulator(objReceiver, args.host, args.udp_port, args.tcp_port, args.push_rate, args.fragment, args.latency/1000)
+  async def run():
+    await objSimulator.start()
+    print('Simulating ' + args.model + ' ' + args.mac + ', discovery on UDP ' + str(objSimulator.intUDPPort) + \
+          ', eISCP on TCP ' + str(objSimulator.intTCPPort))
+    await asyncio.Event().wait()
+  try:
+    asyncio.run(run())
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()